@@ -0,0 +1,169 @@
+"""
+Multi-resolution aggregates for plumber
+
+A pyramid is a dictionary that maps an aggregation level ('hourly', 'daily',
+'monthly', 'annual') onto a dataframe that is indexed by the start of each
+aggregation period and has a two-level column index (variable, statistic),
+where statistic is one of 'mean', 'count', 'min' and 'max'. Each level is
+built from the next finer level rather than from the raw half-hourly data, and
+any level can be updated in place when new data arrive.
+"""
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+# aggregation levels from fine to coarse and the numpy datetime64 unit that
+# is used to floor time stamps to the start of each period
+levels = OrderedDict([('hourly', 'h'),
+                      ('daily', 'D'),
+                      ('monthly', 'M'),
+                      ('annual', 'Y')])
+
+statistics = ['mean', 'count', 'min', 'max']
+
+
+def floorIndex(index, level):
+    """Floor a DatetimeIndex to the start of the aggregation period"""
+    floored = np.asarray(index.values).astype('datetime64[{}]'.
+                                               format(levels[level]))
+    return pd.DatetimeIndex(floored.astype('datetime64[ns]'))
+
+
+def aggregate(df, level):
+    """Aggregate a half-hourly dataframe to a single pyramid level
+
+    Parameters
+    ----------
+    Required:
+        df : pandas dataframe
+            time series with a DatetimeIndex
+        level : string
+            one of the keys in plumber.aggregate.levels
+
+    Returns
+    -------
+    agg : pandas dataframe
+        aggregated dataframe with (variable, statistic) columns
+    """
+    if isinstance(df, pd.Series):
+        df = df.to_frame()
+    grouped = df.groupby(floorIndex(df.index, level))
+    agg = pd.concat([grouped.mean(), grouped.count(), grouped.min(),
+                     grouped.max()], axis=1, keys=statistics)
+    return _reorder(agg)
+
+
+def buildPyramid(df, pyramid_levels=None):
+    """Build a pyramid of aggregates from a half-hourly dataframe. Only the
+       finest level is calculated from df, all others are rolled up from the
+       next finer level
+
+    Parameters
+    ----------
+    Required:
+        df : pandas dataframe or plumber.io.ChunkedTimeSeries
+            time series with a DatetimeIndex. A ChunkedTimeSeries is
+            aggregated chunk by chunk
+    Default:
+        pyramid_levels : list
+            levels to retain in the pyramid (default=all levels)
+
+    Returns
+    -------
+    pyramid : dict
+        dictionary of aggregated dataframes keyed by level
+    """
+    pyramid_levels = _checkLevels(pyramid_levels)
+    if hasattr(df, 'iterChunks'):
+        pyramid = None
+        for chunk in df.iterChunks():
+            if pyramid is None:
+                pyramid = buildPyramid(chunk, pyramid_levels)
+            else:
+                updatePyramid(pyramid, chunk)
+        return pyramid
+    pyramid = {}
+    agg = None
+    for level in levels:
+        if agg is None:
+            agg = aggregate(df, level)
+        else:
+            agg = rollUp(agg, level)
+        if level in pyramid_levels:
+            pyramid[level] = agg
+        if level == pyramid_levels[-1]:
+            break
+    return pyramid
+
+
+def combine(*aggs):
+    """Combine aggregates at the same level into a single aggregate. Periods
+       that occur in more than one of the aggregates are merged"""
+    aggs = [x for x in aggs if x is not None and len(x)]
+    if not aggs:
+        return None
+    agg = pd.concat(aggs, axis=0)
+    if agg.index.is_unique:
+        return agg.sort_index()
+    return _merge(agg, agg.index)
+
+
+def rollUp(agg, level):
+    """Aggregate an existing aggregate to a coarser level"""
+    return _merge(agg, floorIndex(agg.index, level))
+
+
+def updatePyramid(pyramid, df):
+    """Update a pyramid in place with new half-hourly data in df. This is
+       meant for appending time steps that are not yet part of the pyramid,
+       for example when data are processed in chunks. Periods that straddle
+       the boundary between the old and the new data are merged"""
+    finest = [x for x in levels if x in pyramid]
+    if not finest:
+        return pyramid
+    new = buildPyramid(df, finest)
+    for level in finest:
+        pyramid[level] = combine(pyramid[level], new[level])
+    return pyramid
+
+
+def getRange(pyramid, var):
+    """Return (min, max) of var based on the coarsest level in the pyramid"""
+    level = [x for x in levels if x in pyramid][-1]
+    agg = pyramid[level][var]
+    return (agg['min'].min(), agg['max'].max())
+
+
+def _checkLevels(pyramid_levels):
+    """Return pyramid_levels as a list ordered from fine to coarse"""
+    if pyramid_levels is None or pyramid_levels == 'all':
+        return list(levels)
+    if isinstance(pyramid_levels, str):
+        pyramid_levels = [pyramid_levels]
+    unknown = set(pyramid_levels) - set(levels)
+    if unknown:
+        raise ValueError('Unknown aggregation level(s): {}'.
+                         format(', '.join(sorted(unknown))))
+    return [x for x in levels if x in pyramid_levels]
+
+
+def _merge(agg, by):
+    """Merge rows of agg that share the same entry in by"""
+    count = agg.xs('count', axis=1, level=1)
+    total = agg.xs('mean', axis=1, level=1).fillna(0) * count
+    grouped_count = count.groupby(by).sum()
+    merged = pd.concat([total.groupby(by).sum() /
+                        grouped_count.where(grouped_count > 0),
+                        grouped_count,
+                        agg.xs('min', axis=1, level=1).groupby(by).min(),
+                        agg.xs('max', axis=1, level=1).groupby(by).max()],
+                       axis=1, keys=statistics)
+    return _reorder(merged)
+
+
+def _reorder(agg):
+    """Swap the column levels so that the variable comes first"""
+    agg = agg.swaplevel(0, 1, axis=1)
+    variables = list(OrderedDict.fromkeys(agg.columns.get_level_values(0)))
+    columns = pd.MultiIndex.from_product([variables, statistics])
+    return agg.reindex(columns=columns)
@@ -3,12 +3,20 @@ io module for plumber data
 """
 import configparser
 import logging
+import os
 import re
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
 import xray
 from . import utils
 
+# variables that are reconstructed as the sum of other variables if they are
+# not in a file
+derived_vars = OrderedDict([('Rnet', ['SWnet', 'LWnet'])])
 
-def ingest(infile, read_vars, tshift=None):
+
+def ingest(infile, read_vars, tshift=None, chunksize=None):
     """
     read input and output files from the plumber experiment
 
@@ -23,10 +31,14 @@ def ingest(infile, read_vars, tshift=None):
     Default:
         tshift :
             time shift in minutes (default=None)
+        chunksize :
+            number of half-hourly time steps per chunk. If chunksize is set,
+            the data are not read into memory, but a ChunkedTimeSeries is
+            returned instead (default=None)
 
     Returns
     -------
-    ds : pandas dataframe
+    ds : pandas dataframe or ChunkedTimeSeries
         data frame with those elements in read_vars that are present in infile
 
     The returned dataframe is not guaranteed to have all the variables that are
@@ -34,6 +46,80 @@ def ingest(infile, read_vars, tshift=None):
     is up to the user to check for completeness.
     """
 
+    if chunksize:
+        return ChunkedTimeSeries(infile, read_vars, tshift=tshift,
+                                 chunksize=chunksize)
+
+    ds = openDataset(infile, read_vars)
+
+    return _decodeDataFrame(ds, tshift)
+
+
+def ingestCombined(infile, models, read_vars='all', tshift=None):
+    """
+    read a file that combines the output of several models, with variables
+    named {var}_{model}, such as the PLUMBER benchmark files
+    {site}Fluxnet_1.4_PLUMBER_benchmarks.nc. The file is read once and split
+    into a dataframe per model with the model name stripped from the
+    variable names
+
+    Parameters
+    ----------
+    Required:
+        infile : string
+            input file name (netcdf format)
+        models : list
+            models to extract from infile
+    Default:
+        read_vars : list or string ('all')
+            list of variables (without the model name) to read for each
+            model. If read_vars == 'all' then all variables are retained.
+        tshift :
+            time shift in minutes (default=None)
+
+    Returns
+    -------
+    dfs : OrderedDict
+        data frame for each model in models, keyed by model. As in ingest,
+        only the variables that are present in infile are included
+    """
+
+    ds = openDataset(infile, 'all')
+
+    # map {var}_{model} onto (model, var). Longer model names are matched
+    # first, so that a model name that ends in another one is not confused
+    # with it
+    names = OrderedDict()
+    for name in ds.data_vars:
+        for model in sorted(models, key=len, reverse=True):
+            suffix = '_{}'.format(model)
+            if name.endswith(suffix) and len(name) > len(suffix):
+                var = name[:-len(suffix)]
+                if read_vars == 'all' or var in read_vars:
+                    names[name] = (model, var)
+                break
+    ds = ds.drop(list(set(ds.data_vars) - set(names)))
+
+    df = _decodeDataFrame(ds, tshift)
+
+    dfs = OrderedDict()
+    for model in models:
+        columns = [x for x in names if names[x][0] == model]
+        dfs[model] = df[columns].rename(columns=dict([(x, names[x][1])
+                                                      for x in columns]))
+    return dfs
+
+
+def openDataset(infile, read_vars, derive=True):
+    """Open infile without decoding the time axis and without reading the
+       data into memory. The time dimension is renamed to 'time', all other
+       dimensions are dropped and only the variables in read_vars are
+       retained. If derive is True, Rnet is reconstructed from SWnet and
+       LWnet when it is requested but not in infile. This reads both of them
+       into memory. With derive=False, SWnet and LWnet are retained instead,
+       so that the caller can do this for a part of the record (see
+       derived_vars)"""
+
     # make a copy of read_vars since we don't want to change the list in the
     # calling scope
     if read_vars != 'all':
@@ -68,37 +154,152 @@ def ingest(infile, read_vars, tshift=None):
     ds = ds.drop(dims)
 
     # reconstruct Rnet if it is not provided
-    if 'Rnet' in read_vars or read_vars == 'all':
-        if 'Rnet' not in ds.variables:
-            try:
-                ds['Rnet'] = ds['SWnet'] + ds['LWnet']
-            except KeyError:
-                pass
+    for var, components in derived_vars.items():
+        if var in ds.variables or \
+           (read_vars != 'all' and var not in read_vars) or \
+           not all([x in ds.variables for x in components]):
+            continue
+        if derive:
+            ds[var] = sum([ds[x] for x in components[1:]], ds[components[0]])
+        elif read_vars != 'all':
+            read_vars.extend(components)
 
     # drop all variables that are not in read_vars (but keep time)
     if read_vars != 'all':
         read_vars.append('time')
         ds = ds.drop(list(set(ds.variables) - set(read_vars)))
 
-    # align the time according to tshift
-    # The easiest way to do this would be to use
-    # ds = ds.tshift(tshift, freq='T')
-    # However, the tshift() method is currently very slow, so we do the
-    # shift on the raw time axis and then decode after
-    if tshift:
-        ds.time += tshift*60
-    # we don't want partial seconds
-    ds[time_dim].values = ds[time_dim].values.round()
-    ds = xray.decode_cf(ds, decode_times=True)
+    return ds
 
-    # convert to dataframe
-    df = ds.to_dataframe()
 
-    # some of the time stamps in PLUMBER are messed up
-    # regularize
-    df = df.asfreq('30Min', method='nearest')
+class ChunkedTimeSeries(object):
+    """Lazily evaluated, regularized half-hourly time series that is read
+       from a netcdf file in chunks along the time axis. Only the time axis
+       is kept in memory. The data can be processed chunk by chunk with
+       iterChunks(), single variables can be materialized with
+       chunked[var] and the whole record with toDataFrame()."""
 
-    return df
+    def __init__(self, infile, read_vars, tshift=None, chunksize=48*365):
+        self.infile = infile
+        self.read_vars = read_vars
+        self.tshift = tshift
+        self.chunksize = int(chunksize)
+
+        ds = openDataset(infile, read_vars, derive=False)
+        available = list(ds.data_vars)
+        # derived variables are calculated chunk by chunk (see _readChunk)
+        self.derived = {}
+        for var, components in derived_vars.items():
+            if var not in available and \
+               (read_vars == 'all' or var in read_vars) and \
+               all([x in available for x in components]):
+                self.derived[var] = components
+        self.columns = sorted([x for x in available if read_vars == 'all' or
+                               x in read_vars] + list(self.derived))
+        # decode the raw time axis in the same way as ingest() does
+        ds = ds.drop(available)
+        if tshift:
+            ds.time += tshift*60
+        ds['time'].values = ds['time'].values.round()
+        ds = xray.decode_cf(ds, decode_times=True)
+        self.rawtime = pd.DatetimeIndex(ds['time'].values)
+        ds.close()
+
+        # regular index, equivalent to df.asfreq('30Min')
+        self.index = pd.date_range(self.rawtime[0], self.rawtime[-1],
+                                   freq='30Min')
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, key):
+        """Materialize a single variable (as a pandas Series) or a list of
+           variables (as a pandas DataFrame)"""
+        if isinstance(key, str):
+            if key not in self.columns:
+                raise KeyError(key)
+            return self.toDataFrame([key])[key]
+        missing = set(key) - set(self.columns)
+        if missing:
+            raise KeyError(sorted(missing))
+        return self.toDataFrame(list(key))
+
+    def fingerprint(self, var=None):
+        """Identify the data without reading them, based on the file size and
+           modification time of infile and on the way it is read"""
+        stat = os.stat(self.infile)
+        return str((self.infile, stat.st_size, stat.st_mtime, var,
+                    self.tshift, self.index[0], self.index[-1]))
+
+    def iterChunks(self, start=None, end=None, read_vars=None):
+        """Iterate over the record in chunks of self.chunksize time steps.
+           Each chunk is a pandas DataFrame on the regular half-hourly index.
+           If start and/or end are specified, the chunks cover the period
+           from start to end (inclusive). Time steps outside the record are
+           filled with NaN, so that chunks from different sources can be
+           aligned"""
+        if read_vars is None:
+            read_vars = self.columns
+        read_vars = [x for x in read_vars if x in self.columns]
+        index = self._window(start, end)
+        raw_vars = [x for x in read_vars if x not in self.derived]
+        for var in read_vars:
+            raw_vars.extend(self.derived.get(var, []))
+        ds = openDataset(self.infile, sorted(set(raw_vars)), derive=False)
+        try:
+            for i in range(0, len(index), self.chunksize):
+                yield self._readChunk(ds, index[i:i+self.chunksize],
+                                      read_vars)
+        finally:
+            ds.close()
+
+    def toDataFrame(self, read_vars=None, start=None, end=None):
+        """Read the entire record (or the period from start to end) into
+           memory"""
+        chunks = list(self.iterChunks(start, end, read_vars))
+        if not chunks:
+            return pd.DataFrame(index=self._window(start, end),
+                                columns=read_vars)
+        return pd.concat(chunks, axis=0)
+
+    def _readChunk(self, ds, index, read_vars):
+        """Read the raw time steps that are nearest to each entry in index.
+           Derived variables are calculated from their components for this
+           chunk only"""
+        df = pd.DataFrame(index=index, columns=read_vars, dtype=float)
+        inrecord = (index >= self.index[0]) & (index <= self.index[-1])
+        if not inrecord.any():
+            return df
+        # nearest raw time step for each time step on the regular grid
+        target = index[inrecord].asi8
+        raw = self.rawtime.asi8
+        pos = np.clip(np.searchsorted(raw, target), 1, len(raw)-1)
+        left = raw[pos-1]
+        right = raw[pos]
+        # ties go to the later raw time step, as in asfreq(method=nearest)
+        pos -= (target - left) < (right - target)
+        first = pos.min()
+        last = pos.max() + 1
+        chunk = ds.isel(time=slice(first, last))
+        arrays = {}
+        for var in read_vars:
+            names = self.derived.get(var, [var])
+            for name in names:
+                if name not in arrays:
+                    arrays[name] = np.asarray(chunk[name].values, dtype=float)
+            values = sum([arrays[x] for x in names])
+            df.loc[inrecord, var] = values[pos-first]
+        return df
+
+    def _window(self, start=None, end=None):
+        """Regular index from start to end"""
+        if start is None and end is None:
+            return self.index
+        if start is None:
+            start = self.index[0]
+        if end is None:
+            end = self.index[-1]
+        return pd.date_range(start, end, freq='30Min')
 
 
 def parseConfig(configfile=None):
@@ -135,3 +336,28 @@ def parseConfig(configfile=None):
                 cfg[section][key] = utils.cast(cfg[section][key])
     logging.debug('Parsed configuration file %s', configfile)
     return cfg
+
+
+def _decodeDataFrame(ds, tshift=None):
+    """Decode the time axis of a dataset from openDataset, shifted by tshift
+       minutes, and convert it to a regularized half-hourly dataframe"""
+
+    # align the time according to tshift
+    # The easiest way to do this would be to use
+    # ds = ds.tshift(tshift, freq='T')
+    # However, the tshift() method is currently very slow, so we do the
+    # shift on the raw time axis and then decode after
+    if tshift:
+        ds.time += tshift*60
+    # we don't want partial seconds
+    ds['time'].values = ds['time'].values.round()
+    ds = xray.decode_cf(ds, decode_times=True)
+
+    # convert to dataframe
+    df = ds.to_dataframe()
+
+    # some of the time stamps in PLUMBER are messed up
+    # regularize
+    df = df.asfreq('30Min', method='nearest')
+
+    return df
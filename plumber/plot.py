@@ -1,10 +1,14 @@
 """
 Plotting functions for plumber
 """
+import logging
+import os
+import time
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import numpy as np
 import seaborn as sns
+from . import aggregate
 from . import fargs
 from . utils import flatten
 callme = fargs.callFuncBasedOnDict
@@ -25,6 +29,48 @@ def determineExtend(calc_data, vmin, vmax):
     return extend
 
 
+def getDataRange(p, site, sources, var):
+    """Get the range of var across sources at site as an array of (min, max).
+       The range is taken from the aggregate pyramid if it has been built,
+       which avoids a pass over the half-hourly data"""
+    if isinstance(sources, str):
+        sources = [sources]
+    ranges = []
+    for source in sources:
+        try:
+            ranges.append(aggregate.getRange(p.aggregates[site][source], var))
+        except (KeyError, IndexError):
+            values = getSeries(p, site, source, var).values
+            ranges.append((np.nanmin(values), np.nanmax(values)))
+    ranges = np.asarray(ranges, dtype=float)
+    return np.array([np.nanmin(ranges[:, 0]), np.nanmax(ranges[:, 1])])
+
+
+def getSeries(p, site, source, var, time=None):
+    """Select a single time series (a view of the data) with p.select"""
+    return p.select(site, source, var, time)[(site, source, var)]
+
+
+def getYears(p, site, source, var, minimum=100):
+    """Get the years with more than minimum valid time steps of var. The
+       counts come from the validity index if it exists"""
+    try:
+        index = p.validity[site][source]
+        count = index.count
+    except KeyError:
+        index = None
+    if index is None or var not in index:
+        d = getSeries(p, site, source, var)
+        first, last = d.index[0].year, d.index[-1].year
+        return [x for x in range(first, last+1)
+                if getSeries(p, site, source, var, x).count() > minimum]
+    first = index.start.year
+    last = index.end.year
+    return [x for x in range(first, last+1)
+            if count(var, '{}-01-01'.format(x),
+                     '{}-12-31 23:59'.format(x)) > minimum]
+
+
 def getFigSize(info):
     """Create figsize from figwidth and figheight or return default"""
     try:
@@ -53,16 +99,60 @@ def getLimits(info, values, qualifier=''):
     return (low, high)
 
 
+def hovmollerGrid(df):
+    """Mean of a half-hourly series by day of year and hour of day
+
+    Parameters
+    ----------
+    Required:
+        df : pandas Series
+            half-hourly time series
+
+    Returns
+    -------
+    x, y, grid : numpy arrays
+        hour of day of each column, day of year of each row and the mean for
+        each day of year (rows) and half hour (columns). Days without data
+        within the range of days in df are NaN
+    """
+    index = df.index
+    doy = np.asarray(index.dayofyear)
+    minute = np.asarray(index.minute)
+    slot = np.asarray(index.hour)*2 + minute//30
+    values = np.asarray(df.values, dtype=float)
+    valid = ~np.isnan(values)
+    y0 = doy.min()
+    ny = doy.max() - y0 + 1
+    cell = (doy[valid] - y0)*48 + slot[valid]
+    sums = np.bincount(cell, weights=values[valid], minlength=ny*48)
+    counts = np.bincount(cell, minlength=ny*48)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        grid = (sums / counts).reshape(ny, 48)
+    x = np.arange(48)/2 + (minute[0] % 30)/60
+    y = np.arange(y0, y0+ny)
+    return x, y, grid
+
+
+def imshowHovmoller(x, y, grid, zlimits, cmap, ax, im=None):
+    """Draw a regular (day of year, hour of day) grid as an image. If im is
+       an existing image, its data are replaced instead"""
+    extent = [x[0] - 0.25, x[-1] + 0.25, y[0] - 0.5, y[-1] + 0.5]
+    if im is None:
+        im = ax.imshow(grid, extent=extent, origin='lower', aspect='auto',
+                       interpolation='nearest', vmin=zlimits[0],
+                       vmax=zlimits[1], cmap=cmap)
+    else:
+        im.set_data(grid)
+        im.set_extent(extent)
+        im.set_clim(zlimits[0], zlimits[1])
+    ax.axis(extent)
+    return im
+
+
 def plotHovmollerDoyHod(df, zlimits, cmap, ax):
     """Hovmoller plot of day of year versus hour of day"""
-    grouped = df.groupby([lambda x: x.dayofyear,
-                          lambda x: x.hour + x.minute/60]).mean().unstack()
-    x = np.asarray(grouped.axes[1])
-    y = np.asarray(grouped.axes[0])
-    im = ax.axes.pcolormesh(x, y, grouped.values, vmin=zlimits[0],
-                            vmax=zlimits[1], cmap=cmap)
-    ax.axes.axis([x.min(), x.max(), y.min(), y.max()])
-    return im
+    x, y, grid = hovmollerGrid(df)
+    return imshowHovmoller(x, y, grid, zlimits, cmap, ax)
 
 
 def setLegend(axes):
@@ -116,14 +206,10 @@ def plotMeanDiurnalBySiteSingleVar(p, section, **kwargs):
 
     sites = sorted(p.data)
     for site, ax in zip(sites, flatten(axes)):
-        for source in sorted(p.data[site]):
-            df = p.data[site][source]
-            try:
-                df[info['read_vars']].\
-                    groupby(lambda x: x.hour +
-                            x.minute/60).mean().plot(ax=ax, label=source)
-            except KeyError:
-                pass
+        selection = p.select(sites=site, read_vars=info['read_vars'])
+        for (_, source, _), d in selection.items():
+            d.groupby(lambda x: x.hour +
+                      x.minute/60).mean().plot(ax=ax, label=source)
 
     for site, ax in zip(sites, flatten(axes)):
         ax.text(0.05, 0.95, site, horizontalalignment='left',
@@ -164,11 +250,7 @@ def plotHovmollerDoyVsHodByYear(p, section, **kwargs):
     source = info['source']
     var = info['read_vars']
 
-    d = p.data[site][source][var]
-    years = []
-    for year in range(d.index[0].year, d.index[-1].year+1):
-        if d[str(year)].shape[0] > 100:
-            years.append(year)
+    years = getYears(p, site, source, var)
 
     nrows = 1
     ncols = len(years)
@@ -176,16 +258,17 @@ def plotHovmollerDoyVsHodByYear(p, section, **kwargs):
     fig, axes = callme(plt.subplots, info, nrows=nrows, ncols=ncols,
                        squeeze=False, figsize=info['figsize'], **kwargs)
     cmap = plt.get_cmap(info['cmap'])
-    zlimits = getLimits(info, d.values)
+    value_range = getDataRange(p, site, source, var)
+    zlimits = getLimits(info, value_range)
 
     for ax, year in zip(axes.flat, years):
-        df = d[str(year)]
+        df = getSeries(p, site, source, var, year)
         im = plotHovmollerDoyHod(df, zlimits, cmap, ax)
 
     if 'label' not in info:
         info['label'] = var
 
-    extend = determineExtend(d.valuess, zlimits[0], zlimits[1])
+    extend = determineExtend(value_range, zlimits[0], zlimits[1])
     callme(fig.colorbar, info, mappable=im, ax=axes.ravel().tolist(),
            label=info['label'], extend=extend)
 
@@ -228,12 +311,9 @@ def plotHovmollerDoyVsHodByYearComparison(p, section, **kwargs):
     source1, source2 = info['source'][0:2]
     var = info['read_vars']
 
-    d1 = p.data[site][source1][var]
-    d2 = p.data[site][source2][var]
-    years = []
-    for year in range(d1.index[0].year, d1.index[-1].year+1):
-        if d1[str(year)].shape[0] > 100:
-            years.append(year)
+    d1 = getSeries(p, site, source1, var)
+    d2 = getSeries(p, site, source2, var)
+    years = getYears(p, site, source1, var)
 
     nrows = 3
     ncols = len(years)
@@ -242,13 +322,14 @@ def plotHovmollerDoyVsHodByYearComparison(p, section, **kwargs):
                        squeeze=False, figsize=info['figsize'], **kwargs)
 
     cmap = plt.get_cmap(info['cmap'])
-    zlimits = getLimits(info, d1.values+d2.values)
-    for row, d in enumerate([d1, d2]):
+    value_range = getDataRange(p, site, [source1, source2], var)
+    zlimits = getLimits(info, value_range)
+    for row, source in enumerate([source1, source2]):
         for ax, year in zip(axes[row, :].flat, years):
-            df = d[str(year)]
+            df = getSeries(p, site, source, var, year)
             im = plotHovmollerDoyHod(df, zlimits, cmap, ax)
 
-    extend = determineExtend(d1.values+d2.values, zlimits[0], zlimits[1])
+    extend = determineExtend(value_range, zlimits[0], zlimits[1])
     callme(fig.colorbar, info, mappable=im, ax=axes[0:2, :].ravel().tolist(),
            label=info['label'], extend=extend)
 
@@ -256,7 +337,7 @@ def plotHovmollerDoyVsHodByYearComparison(p, section, **kwargs):
     cmap = plt.get_cmap(info['cmap_diff'])
     zlimits = getLimits(info, d.values, '_diff')
     for ax, year in zip(axes[2, :].flat, years):
-        df = d[str(year)]
+        df = d.loc[str(year)]
         im = plotHovmollerDoyHod(df, zlimits, cmap, ax)
 
     extend = determineExtend(d.values, zlimits[0], zlimits[1])
@@ -309,7 +390,7 @@ def plotHovmollerDoyVsHodMean(p, section, **kwargs):
     source = info['source']
     var = info['read_vars']
 
-    df = p.data[site][source][var]
+    df = getSeries(p, site, source, var)
 
     nrows = 1
     ncols = 1
@@ -317,14 +398,15 @@ def plotHovmollerDoyVsHodMean(p, section, **kwargs):
                        squeeze=False, figsize=info['figsize'], **kwargs)
     ax = axes[0][0]
     cmap = plt.get_cmap(info['cmap'])
-    zlimits = getLimits(info, df.values)
+    value_range = getDataRange(p, site, source, var)
+    zlimits = getLimits(info, value_range)
 
     im = plotHovmollerDoyHod(df, zlimits, cmap, ax)
 
     if 'label' not in info:
         info['label'] = var
 
-    extend = determineExtend(df.values, zlimits[0], zlimits[1])
+    extend = determineExtend(value_range, zlimits[0], zlimits[1])
     callme(fig.colorbar, info, mappable=im, ax=[axes[0][0]],
            label=info['label'], extend=extend)
 
@@ -366,8 +448,8 @@ def plotHovmollerDoyVsHodMeanComparison(p, section, **kwargs):
     source1, source2 = info['source'][0:2]
     var = info['read_vars']
 
-    df1 = p.data[site][source1][var]
-    df2 = p.data[site][source2][var]
+    df1 = getSeries(p, site, source1, var)
+    df2 = getSeries(p, site, source2, var)
     diff = df1 - df2
 
     nrows = 1
@@ -377,12 +459,13 @@ def plotHovmollerDoyVsHodMeanComparison(p, section, **kwargs):
                        squeeze=False, figsize=info['figsize'], **kwargs)
 
     cmap = plt.get_cmap(info['cmap'])
-    zlimits = getLimits(info, df1.values+df2.values)
+    value_range = getDataRange(p, site, [source1, source2], var)
+    zlimits = getLimits(info, value_range)
 
     im = plotHovmollerDoyHod(df1, zlimits, cmap, axes[0][0])
     im = plotHovmollerDoyHod(df2, zlimits, cmap, axes[0][1])
 
-    extend = determineExtend(df1.values+df2.values, zlimits[0], zlimits[1])
+    extend = determineExtend(value_range, zlimits[0], zlimits[1])
     callme(fig.colorbar, info, mappable=im, ax=axes[0, 0:2].ravel().tolist(),
            label=info['label'], extend=extend)
 
@@ -408,3 +491,289 @@ def plotHovmollerDoyVsHodMeanComparison(p, section, **kwargs):
 
     return fig, axes
 
+
+def plotSpectra(p, section, **kwargs):
+    """Plot power spectra, coherence and lagged correlation of a single
+       variable for selected sources against the observations at a site (see
+       plumber.spectral). Optional section entries are obs (default 'flux'),
+       maxlag (maximum lag in hours, default 72) and nbands (number of
+       frequency bands, default 50). If source is absent, all models at the
+       site are included
+
+    Parameters
+    ----------
+    Required:
+        p : PlumberAnalysis instance
+        section : key for p.cfg that has info that is specific to this plot,
+                  i.e. p.cfg[section]
+
+    Returns
+    -------
+    fig, axes : matplotlib Figure and Axes instance
+    """
+
+    setPlotDefaults(p.cfg['plot_defaults'])
+    info = p.cfg[section]
+    info['figsize'] = getFigSize(info)
+
+    site = info['site']
+    var = info['read_vars']
+    obs = info.get('obs', 'flux')
+    maxlag = int(round(info.get('maxlag', 72) * 2))
+    result = p.calcSpectra(site, var, info.get('source'), obs, maxlag,
+                           info.get('nbands', 50))
+
+    fig, axes = callme(plt.subplots, info, nrows=1, ncols=3, squeeze=False,
+                       figsize=info['figsize'], **kwargs)
+    ax_power, ax_coherence, ax_correlation = axes[0]
+    result['power'].plot(ax=ax_power, logx=True, logy=True)
+    result['coherence'].plot(ax=ax_coherence, logx=True)
+    result['correlation'].plot(ax=ax_correlation)
+
+    # mark the annual and diurnal cycles
+    for ax in (ax_power, ax_coherence):
+        for frequency in (1/365., 1.):
+            ax.axvline(frequency, color='0.7', linestyle=':', zorder=0)
+    ax_correlation.axvline(0, color='0.7', linestyle=':', zorder=0)
+
+    ax_power.set_ylabel('Power spectral density')
+    ax_coherence.set_ylabel('Coherence with {}'.format(obs))
+    ax_coherence.set_ylim(0, 1)
+    ax_correlation.set_ylabel('Correlation with {}'.format(obs))
+    ax_power.set_xlabel('Frequency (cycles per day)')
+    ax_coherence.set_xlabel('Frequency (cycles per day)')
+    ax_correlation.set_xlabel('Lag (hours)')
+
+    fig.suptitle('{}: {}'.format(site, var))
+    setLegend(axes)
+    fig.tight_layout(rect=(0, 0, 1, 0.95))
+
+    callme(fig.savefig, info, filename=info['plotfilename'], **kwargs)
+
+    return fig, axes
+
+
+# plot functions that render one figure per (site, source) in a batch. Their
+# site entry can be a list and their plotfilename a template (see
+# getBatchJobs)
+batch_plots = ['plotHovmollerDoyVsHodMeanBatch',
+               'plotHovmollerDoyVsHodMeanComparisonBatch']
+
+
+def getBatchJobs(p, section):
+    """List the figures for a batch plot section. The section's site entry
+       can be a single site, a list of sites or absent (all loaded sites).
+       For plotHovmollerDoyVsHodMeanComparisonBatch, all sources are compared
+       against the last source in the source entry. Sites that do not belong
+       to the current shard of p are skipped
+
+    Returns
+    -------
+    jobs : list
+        list of (site, sources, filename), where filename is plotfilename
+        formatted with site, source (the first source) and source2 (the
+        second source, if any)
+    """
+    info = p.cfg[section]
+    var = info['read_vars']
+    sites = info.get('site')
+    if sites is None:
+        sites = sorted(p.data)
+    elif isinstance(sites, str):
+        sites = [sites]
+    sources = info['source']
+    if isinstance(sources, str):
+        sources = [sources]
+    if info['plot'] == 'plotHovmollerDoyVsHodMeanComparisonBatch':
+        combinations = [[x, sources[-1]] for x in sources[:-1]]
+    else:
+        combinations = [[x] for x in sources]
+    jobs = []
+    for site in sites:
+        for combination in combinations:
+            keys = p.selectKeys(site, combination, var)
+            if len(keys) < len(combination) or \
+               not all([p.inShard(site, x) for x in combination]):
+                continue
+            names = dict(site=site, source=combination[0],
+                         source2=combination[-1])
+            jobs.append((site, combination,
+                         info['plotfilename'].format(**names)))
+    return jobs
+
+
+def getPlotFilenames(p, section):
+    """List all the files that are written by a plot section"""
+    info = p.cfg[section]
+    if info['plot'] in batch_plots:
+        return [x[2] for x in getBatchJobs(p, section)]
+    return [info['plotfilename']]
+
+
+def updateColorbar(cbar, im, extend):
+    """Point an existing colorbar at im and change its extension"""
+    cbar.extend = extend
+    cbar.update_normal(im)
+
+
+def plotHovmollerDoyVsHodMeanBatch(p, section, jobs=None, **kwargs):
+    """Batch version of plotHovmollerDoyVsHodMean that renders one figure per
+       site and source. The figure, colorbar and labels are created once and
+       only the image data, limits and title are replaced for each figure.
+       The colour limits come from the aggregate pyramid if it exists (see
+       getDataRange)
+
+    Parameters
+    ----------
+    Required:
+        p : PlumberAnalysis instance
+        section : key for p.cfg that has info that is specific to this plot,
+                  i.e. p.cfg[section]. plotfilename should contain {site}
+                  and {source} (see getBatchJobs)
+
+    Default:
+        jobs : list
+            subset of getBatchJobs(p, section) to render (default=all)
+
+    Returns
+    -------
+    fig, axes : matplotlib Figure and Axes instance
+    timing : list of (filename, seconds, bytes) for each figure
+    """
+
+    setPlotDefaults(p.cfg['plot_defaults'])
+    info = p.cfg[section]
+    info['figsize'] = getFigSize(info)
+    var = info['read_vars']
+    if 'label' not in info:
+        info['label'] = var
+    info['ylabel'] = 'Day of year'
+    info['xlabel'] = 'Hour of day'
+
+    fig, axes = callme(plt.subplots, info, nrows=1, ncols=1, squeeze=False,
+                       figsize=info['figsize'], **kwargs)
+    ax = axes[0][0]
+    cmap = plt.get_cmap(info['cmap'])
+    setXYLabels(axes, info, **kwargs)
+    title = fig.suptitle('')
+
+    im = None
+    cbar = None
+    timing = []
+    if jobs is None:
+        jobs = getBatchJobs(p, section)
+    for site, sources, filename in jobs:
+        t0 = time.time()
+        source = sources[0]
+        value_range = getDataRange(p, site, source, var)
+        zlimits = getLimits(info, value_range)
+        extend = determineExtend(value_range, zlimits[0], zlimits[1])
+        x, y, grid = hovmollerGrid(getSeries(p, site, source, var))
+        im = imshowHovmoller(x, y, grid, zlimits, cmap, ax, im)
+        if cbar is None:
+            cbar = callme(fig.colorbar, info, mappable=im, ax=[ax],
+                          label=info['label'], extend=extend)
+        else:
+            updateColorbar(cbar, im, extend)
+        title.set_text('{} @ {}: {}'.format(source, site, var))
+        callme(fig.savefig, info, filename=filename, **kwargs)
+        timing.append(_timeFigure(filename, t0))
+
+    return fig, axes, timing
+
+
+def plotHovmollerDoyVsHodMeanComparisonBatch(p, section, jobs=None, **kwargs):
+    """Batch version of plotHovmollerDoyVsHodMeanComparison that renders one
+       figure per site and source. Each source in the section's source entry
+       other than the last one is compared against the last one. The figure,
+       colorbars and labels are created once and only the image data, limits
+       and titles are replaced for each figure
+
+    Parameters
+    ----------
+    Required:
+        p : PlumberAnalysis instance
+        section : key for p.cfg that has info that is specific to this plot,
+                  i.e. p.cfg[section]. plotfilename should contain {site},
+                  {source} and {source2} (see getBatchJobs)
+
+    Default:
+        jobs : list
+            subset of getBatchJobs(p, section) to render (default=all)
+
+    Returns
+    -------
+    fig, axes : matplotlib Figure and Axes instance
+    timing : list of (filename, seconds, bytes) for each figure
+    """
+
+    setPlotDefaults(p.cfg['plot_defaults'])
+    info = p.cfg[section]
+    info['figsize'] = getFigSize(info)
+    var = info['read_vars']
+    if 'label' not in info:
+        info['label'] = var
+    info['ylabel'] = 'Day of year'
+    info['xlabel'] = 'Hour of day'
+
+    fig, axes = callme(plt.subplots, info, nrows=1, ncols=3, squeeze=False,
+                       figsize=info['figsize'], **kwargs)
+    cmap = plt.get_cmap(info['cmap'])
+    cmap_diff = plt.get_cmap(info['cmap_diff'])
+    setXYLabels(axes, info, **kwargs)
+    title = fig.suptitle('')
+    axes[0][2].set_title('Delta (1-2)')
+
+    ims = [None, None, None]
+    cbars = None
+    timing = []
+    if jobs is None:
+        jobs = getBatchJobs(p, section)
+    for site, sources, filename in jobs:
+        t0 = time.time()
+        source1, source2 = sources
+        value_range = getDataRange(p, site, sources, var)
+        zlimits = getLimits(info, value_range)
+        extend = determineExtend(value_range, zlimits[0], zlimits[1])
+        df1 = getSeries(p, site, source1, var)
+        df2 = getSeries(p, site, source2, var)
+        for i, df in enumerate([df1, df2]):
+            x, y, grid = hovmollerGrid(df)
+            ims[i] = imshowHovmoller(x, y, grid, zlimits, cmap, axes[0][i],
+                                     ims[i])
+        diff = df1 - df2
+        diff_range = np.array([np.nanmin(diff.values),
+                               np.nanmax(diff.values)])
+        zlimits_diff = getLimits(info, diff_range, '_diff')
+        extend_diff = determineExtend(diff_range, zlimits_diff[0],
+                                      zlimits_diff[1])
+        x, y, grid = hovmollerGrid(diff)
+        ims[2] = imshowHovmoller(x, y, grid, zlimits_diff, cmap_diff,
+                                 axes[0][2], ims[2])
+        if cbars is None:
+            cbars = [callme(fig.colorbar, info, mappable=ims[1],
+                            ax=axes[0, 0:2].ravel().tolist(),
+                            label=info['label'], extend=extend),
+                     callme(fig.colorbar, info, mappable=ims[2],
+                            ax=[axes[0, 2]],
+                            label='Delta {}'.format(info['label']),
+                            extend=extend_diff)]
+        else:
+            updateColorbar(cbars[0], ims[1], extend)
+            updateColorbar(cbars[1], ims[2], extend_diff)
+        title.set_text('{} and {} @ {}: {}'.format(source1, source2, site,
+                                                   var))
+        axes[0][0].set_title(source1)
+        axes[0][1].set_title(source2)
+        callme(fig.savefig, info, filename=filename, **kwargs)
+        timing.append(_timeFigure(filename, t0))
+
+    return fig, axes, timing
+
+
+def _timeFigure(filename, t0):
+    """Log and return the time since t0 and the size of filename"""
+    elapsed = time.time() - t0
+    size = os.path.getsize(filename)
+    logging.info('Rendered %s in %.3f s (%d bytes)', filename, elapsed, size)
+    return (filename, elapsed, size)
@@ -1,14 +1,35 @@
+import argparse
+import concurrent.futures
 import configparser
+import copy
+import hashlib
+import json
 import logging
 import os
 import pickle
+import queue
 import re
-import sys
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from . import aggregate
 from . import io
 from . import plot as plumberplot
+from . import server
+from . import spectral
+from . import stats as plumberstats
+from . import utils
+from . import validity
 
 loglevel_default = 'info'
 
+# columns in the stats table (see PlumberAnalysis.calcStats)
+results_columns = ['site', 'source', 'variable', 'metric', 'value']
+
+# cache for _moduleFingerprint
+_module_fingerprints = {}
+
 
 class PlumberAnalysis(object):
     """Overarching class for organizing analysis of the PLUMBER dataset.
@@ -25,6 +46,22 @@ class PlumberAnalysis(object):
         # Since data is not pickled as part of the class instance, we maintain
         # a separate data_dict to help restore_data()
         self.data_dict = {}
+        # Pyramid of aggregates by site and source (see plumber.aggregate).
+        # Like data, these are pickled separately
+        self.aggregates = {}
+        # Validity bitmaps and gap index by site and source (see
+        # plumber.validity). These are pickled separately as well
+        self.validity = {}
+        # Table of stats (see calcStats)
+        self.results = None
+        # Cache of data fingerprints (see atomFingerprint)
+        self.fingerprints = {}
+        # Cache of spectral analyses (see calcSpectra)
+        self.spectra = {}
+        # (shard, nshards) if only part of the analysis is done by this
+        # instance (see setShard)
+        self.shard = None
+        self.shard_by = 'site'
 
     def __getstate__(self):
         """Define what will be pickled"""
@@ -36,8 +73,75 @@ class PlumberAnalysis(object):
         # will be pickled separately, to avoid the python bug with writing
         # large files on OS X
         del state['data']
+        del state['aggregates']
+        del state['validity']
+        del state['fingerprints']
         return state
 
+    def __setstate__(self, state):
+        """Restore the pickled state. data, aggregates and validity need to be
+           restored separately with restoreData"""
+        self.results = None
+        self.shard = None
+        self.shard_by = 'site'
+        self.spectra = {}
+        self.__dict__.update(state)
+        self.data = {}
+        self.aggregates = {}
+        self.validity = {}
+        self.fingerprints = {}
+
+    def aggregateLevels(self):
+        """Return the list of aggregation levels specified by
+           aggregate_levels in the [ANALYSIS] section of the configuration
+           file or None if aggregates should not be built at ingest"""
+        try:
+            pyramid_levels = self.cfg['analysis']['aggregate_levels']
+        except KeyError:
+            return None
+        if pyramid_levels is None or pyramid_levels is False:
+            return None
+        if pyramid_levels is True:
+            pyramid_levels = 'all'
+        return pyramid_levels
+
+    def buildAggregates(self, site=None, source=None, pyramid_levels=None):
+        """Build the pyramid of aggregates for the selected site and source
+           (default is all sites and sources that have been loaded). If
+           pyramid_levels is None, the levels are taken from the configuration
+           file and if not specified there, all levels are built"""
+        if pyramid_levels is None:
+            pyramid_levels = self.aggregateLevels()
+        sites = [site] if site is not None else sorted(self.data)
+        for site in sites:
+            sources = [source] if source is not None else \
+                sorted(self.data[site])
+            for source in sources:
+                if site not in self.aggregates:
+                    self.aggregates[site] = {}
+                self.aggregates[site][source] = \
+                    aggregate.buildPyramid(self.data[site][source],
+                                           pyramid_levels)
+                logging.debug('Aggregated %s %s', site, source)
+
+    def getAggregate(self, site, source, level):
+        """Return the aggregate for site and source at level. The pyramid is
+           built if it does not exist yet or if it does not include level"""
+        try:
+            return self.aggregates[site][source][level]
+        except KeyError:
+            pass
+        try:
+            pyramid = self.aggregates[site][source]
+            pyramid_levels = list(set(pyramid).union([level]))
+        except KeyError:
+            pyramid_levels = self.aggregateLevels()
+            if pyramid_levels is None or pyramid_levels == 'all':
+                pyramid_levels = list(aggregate.levels)
+            pyramid_levels = list(set(pyramid_levels).union([level]))
+        self.buildAggregates(site, source, pyramid_levels)
+        return self.aggregates[site][source][level]
+
     def ingest(self, site, source, *args, **kwargs):
         """Ingest a timeseries for a given site and source. All variables other
            than site and source are simply handed to plumber.io.ingest"""
@@ -46,55 +150,805 @@ class PlumberAnalysis(object):
             self.data_dict[site] = []
         self.data[site][source] = io.ingest(*args, **kwargs)
         logging.debug('Loaded %s %s', site, source)
+        self._clearFingerprints(site, source)
+        self._updateAggregates(site, source)
+        self._updateValidity(site, source)
         if source not in self.data_dict[site]:
             self.data_dict[site].append(source)
 
-    def ingestAll(self, read_vars='all'):
-        """Ingest time series for all sites and sources"""
-        # Ingest all entries in the models section
+    def ingestCombined(self, site, infile, sources, read_vars='all',
+                       tshift=None):
+        """Ingest the time series for several sources at a site from a single
+           file in which the variables are named {var}_{source}, see
+           plumber.io.ingestCombined. Sources without any of the variables
+           in read_vars are skipped"""
+        dfs = io.ingestCombined(infile, sources, read_vars, tshift=tshift)
+        for source, df in dfs.items():
+            if not len(df.columns):
+                logging.warning('No variables for %s in %s', source, infile)
+                continue
+            self._addAtom(site, source, df)
+            logging.debug('Loaded %s %s from %s', site, source, infile)
+
+    def ingestRequired(self, plots=True, stats=True, chunksize=None,
+                       workers=None):
+        """Ingest only the sites, sources and variables that are needed by the
+           plot sections (if plots is True) and by calcStats (if stats is
+           True), see requirements. The files are read, validated and
+           aggregated in parallel by up to workers processes (default is the
+           number of processors). With workers=1, everything is done in the
+           current process. Sources in a combined file (see combinedTemplate)
+           are read together, with one read per site. chunksize is handled
+           as in ingestAll"""
+        if chunksize is None:
+            chunksize = self.cfg.get('analysis', {}).get('chunksize')
+        needs = self.requirements(plots, stats)
+        jobs = []
+        for site, infile, tshift, sources, combined in self.atomGroups():
+            sources = [x for x in sources if (site, x) in needs]
+            if not sources:
+                continue
+            read_vars = [needs[(site, x)][0] for x in sources]
+            pyramid_levels = []
+            for source in sources:
+                try:
+                    pyramid_levels.append(
+                        list(self.aggregates[site][source]))
+                except KeyError:
+                    pyramid_levels.append(self.aggregateLevels())
+            jobs.append(((site, sources),
+                         (infile, sources, combined, read_vars, tshift,
+                          chunksize, pyramid_levels)))
+        if workers == 1:
+            results = [_readAtoms(*x[1]) for x in jobs]
+        else:
+            executor = concurrent.futures.ProcessPoolExecutor(workers)
+            with executor:
+                results = [executor.submit(_readAtoms, *x[1]) for x in jobs]
+                results = [x.result() for x in results]
+        for ((site, sources), args), result in zip(jobs, results):
+            if isinstance(result, Exception):
+                print('Failure to read {}'.format(args[0]))
+                logging.critical('Failure to read %s', args[0])
+                raise result
+            for source, read_vars, atom in zip(sources, args[3], result):
+                if atom is None:
+                    logging.debug('Skipped %s %s: none of %s available',
+                                  site, source, read_vars)
+                    continue
+                self._addAtom(site, source, *atom)
+                logging.debug('Loaded %s %s', site, source)
+
+    def requirements(self, plots=True, stats=True, obs='flux'):
+        """Build the dependency graph between the configuration and the data.
+           Each plot section (if plots is True) needs the variables in its
+           read_vars for its site(s) and source(s), where a missing entry
+           means all, and plotSpectra sections also need their observations
+           (obs). calcStats (if stats is True) needs stats_vars (or all
+           variables) for all models and the observations obs at all sites.
+           Only sites and sources in the current shard are included.
+
+        Returns
+        -------
+        needs : OrderedDict
+            (read_vars, reasons) keyed by (site, source) in the order of
+            atoms(). read_vars is a sorted list of variables or 'all' and
+            reasons lists the sections (and 'stats') that need the atom
+        """
+        sites = _asList(self.cfg['sites']['sites'], None)
+        models = list(utils.flatten([_asList(x, None) for x in
+                                     self.cfg['sources'].values()]))
+        observations = _asList(self.cfg['observations']['observations'],
+                               None)
+        demands = []
+        if plots:
+            for section in self.cfg:
+                if not re.match(u'plot_', section) or \
+                   section == 'plot_defaults':
+                    continue
+                info = self.cfg[section]
+                demands.append((section,
+                                _asList(info.get('site'), sites),
+                                _sectionSources(info,
+                                                models + observations),
+                                _asList(info.get('read_vars'), 'all')))
+        if stats:
+            demands.append(('stats', sites, models + [obs],
+                            _asList(self.cfg.get('analysis', {}).
+                                    get('stats_vars'), 'all')))
+        graph = {}
+        for reason, demand_sites, demand_sources, read_vars in demands:
+            if 'all' in read_vars:
+                read_vars = 'all'
+            for site in demand_sites:
+                for source in demand_sources:
+                    read_vars_, reasons = graph.get((site, source),
+                                                    (set(), []))
+                    if read_vars == 'all' or read_vars_ == 'all':
+                        read_vars_ = 'all'
+                    else:
+                        read_vars_ = read_vars_.union(read_vars)
+                    graph[(site, source)] = (read_vars_, reasons + [reason])
+        needs = OrderedDict()
+        for site, source, infile, tshift in self.atoms():
+            if (site, source) in graph:
+                read_vars, reasons = graph[(site, source)]
+                if read_vars != 'all':
+                    read_vars = sorted(read_vars)
+                needs[(site, source)] = (read_vars, reasons)
+        return needs
+
+    def explain(self, plots=True, stats=True):
+        """List what ingestRequired will read and why, one line per site and
+           source. The listing is printed and returned"""
+        lines = []
+        infiles = dict([((x[0], x[1]), x[2]) for x in self.atoms()])
+        for (site, source), (read_vars, reasons) in \
+                self.requirements(plots, stats).items():
+            if read_vars != 'all':
+                read_vars = ','.join(read_vars)
+            lines.append('{} {}: {} from {} (needed by {})'.
+                         format(site, source, read_vars,
+                                infiles[(site, source)], ', '.join(reasons)))
+        if not lines:
+            lines.append('Nothing to read')
+        print('\n'.join(lines))
+        return lines
+
+    def ingestAll(self, read_vars='all', chunksize=None, stream_to=None):
+        """Ingest time series for all sites and sources (that belong to the
+           current shard). If chunksize is set (or chunksize is specified in
+           the [ANALYSIS] section of the configuration file), the data are not
+           read into memory, but are stored as plumber.io.ChunkedTimeSeries
+           that are evaluated chunk by chunk.
+
+           If stream_to is set, the analysis is stored in that path as it is
+           ingested (see store). Each site and source is handed to a
+           background thread that writes it while the next file is read and
+           is then dropped from memory, so that only data_dict and the
+           metadata remain. Use restoreData to read the data back.
+
+           Sources that are read from a combined file (see combinedTemplate)
+           are read with a single read per site and are always read into
+           memory"""
+        if chunksize is None:
+            chunksize = self.cfg.get('analysis', {}).get('chunksize')
+        writer = None
+        if stream_to is not None:
+            writer = _AtomWriter(stream_to)
+        try:
+            for site, infile, tshift, sources, combined in self.atomGroups():
+                try:
+                    if combined:
+                        self.ingestCombined(site, infile, sources,
+                                            read_vars=read_vars,
+                                            tshift=tshift)
+                    else:
+                        self.ingest(site, sources[0], infile,
+                                    read_vars=read_vars, tshift=tshift,
+                                    chunksize=chunksize)
+                except ValueError:
+                    print('Failure to read {}'.format(infile))
+                    logging.critical('Failure to read %s', infile)
+                    raise
+                if writer is None:
+                    continue
+                for source in sources:
+                    if source not in self.data[site]:
+                        continue
+                    writer.put(site, source, self.data[site].pop(source),
+                               self.aggregates.get(site, {}).pop(source,
+                                                                 None),
+                               self.validity[site].pop(source))
+        finally:
+            if writer is not None:
+                writer.close()
+        if stream_to is not None:
+            self._storeInstance(stream_to)
+
+    def atoms(self):
+        """Generate (site, source, infile, tshift) for all sites and sources
+           in the configuration that belong to the current shard. Models are
+           listed first, followed by the observations"""
+        # All entries in the models section
         for category in self.cfg['sources']:
             for source in self.cfg['sources'][category]:
                 try:
                     tshift = self.cfg['tshifts'][source.lower()]
                 except KeyError:
                     tshift = None
+                template = self.combinedTemplate(source)
+                if template is None:
+                    template = \
+                        self.cfg['filetemplates'][category+'_file_template']
                 for site in self.cfg['sites']['sites']:
-                    infile = \
-                        self.cfg['filetemplates'][category+'_file_template'].\
-                        format(site=site, model=source)
-                    try:
-                        self.ingest(site, source, infile, read_vars=read_vars,
-                                    tshift=tshift)
-                    except ValueError:
-                        print('Failure to read {}'.format(infile))
-                        logging.critical('Failure to read %s', infile)
-                        raise
-
-        # Ingest all the observations
+                    if not self.inShard(site, source):
+                        continue
+                    infile = template.format(site=site, model=source)
+                    yield site, source, infile, tshift
+
+        # All the observations
         for category in self.cfg['observations']['observations']:
             for site in self.cfg['sites']['sites']:
+                if not self.inShard(site, category):
+                    continue
                 infile = self.cfg['filetemplates'][category+'_file_template'].\
                              format(site=site)
-                self.ingest(site, category, infile, read_vars=read_vars)
+                yield site, category, infile, None
+
+    def atomGroups(self):
+        """Group atoms() by the file that they are read from. Sources that
+           are read from the same combined file (see combinedTemplate) with
+           the same tshift form a single group, all other sources are a group
+           of their own. Returns a list of (site, infile, tshift, sources,
+           combined)"""
+        groups = OrderedDict()
+        for site, source, infile, tshift in self.atoms():
+            combined = self.combinedTemplate(source) is not None
+            key = (site, infile, tshift) if combined else (site, source)
+            if key not in groups:
+                groups[key] = (site, infile, tshift, [], combined)
+            groups[key][3].append(source)
+        return list(groups.values())
+
+    def combinedTemplate(self, source):
+        """Return the template of the combined file that source is read from
+           or None if source has its own files. A combined file holds the
+           output of all the sources in a category for a site, with the
+           variables named {var}_{source}. It is specified by
+           {category}_combined_file_template in the [FILETEMPLATES] section
+           of the configuration file, which takes precedence over
+           {category}_file_template"""
+        for category, sources in self.cfg['sources'].items():
+            if source in _asList(sources, []):
+                return self.cfg['filetemplates'].\
+                    get(category+'_combined_file_template')
+        return None
+
+    def calcStats(self, read_vars=None, obs='flux'):
+        """Calculate the statistics in plumber.stats.calcAllStats for all
+           sources against the observations obs at each site. Only sources
+           that belong to the current shard are included. The results are
+           returned as a table with one row per site, source, variable and
+           metric and are also kept in self.results. read_vars defaults to
+           stats_vars in the [ANALYSIS] section of the configuration file
+           and otherwise to all variables that are common to the source and
+           the observations. The stats are based on the time steps at which
+           both the source and the observations are valid (see
+           plumber.validity). If stats_level is set in the [ANALYSIS]
+           section, the stats are calculated from the means at that
+           aggregation level instead of from the half-hourly data"""
+        analysis = self.cfg.get('analysis', {})
+        if read_vars is None:
+            read_vars = analysis.get('stats_vars')
+        if isinstance(read_vars, str):
+            read_vars = [read_vars]
+        level = analysis.get('stats_level')
+        observations = self.cfg['observations']['observations']
+        rows = []
+        for site in sorted(self.data):
+            if obs not in self.data[site]:
+                continue
+            for source in sorted(self.data[site]):
+                if source in observations or not self.inShard(site, source):
+                    continue
+                stats = self.calcAtomStats(site, source, read_vars, obs,
+                                           level)
+                if stats is None:
+                    continue
+                for metric in sorted(stats):
+                    for var, value in stats[metric].items():
+                        rows.append((site, source, var, metric, value))
+                logging.debug('Calculated stats for %s %s', site, source)
+        self.results = pd.DataFrame(rows, columns=results_columns)
+        return self.results
+
+    def calcAtomStats(self, site, source, read_vars=None, obs='flux',
+                      level=None):
+        """Calculate the statistics in plumber.stats.calcAllStats for a single
+           site and source against the observations obs, as in calcStats,
+           but without storing them. Returns None if source and obs have no
+           variables in common (among read_vars, if it is set) or are not on
+           the same time grid"""
+        d1 = self.data[site][source]
+        d2 = self.data[site][obs]
+        variables = [x for x in d1.columns if x in d2.columns]
+        if read_vars is not None:
+            variables = [x for x in variables if x in read_vars]
+        if not variables:
+            return None
+        if level:
+            d1 = self.getAggregate(site, source, level).\
+                xs('mean', axis=1, level=1)[variables]
+            d2 = self.getAggregate(site, obs, level).\
+                xs('mean', axis=1, level=1)[variables]
+            return plumberstats.calcAllStats(d1, d2)
+        if not self._sameGrid(site, source, obs):
+            return None
+        if isinstance(d1, io.ChunkedTimeSeries) or \
+                isinstance(d2, io.ChunkedTimeSeries):
+            return plumberstats.calcAllStatsChunked(
+                d1, d2, variables=variables, pairwise=True)
+        d1, d2 = self._pairedFrames(site, source, obs, variables)
+        return plumberstats.calcAllStats(d1, d2)
+
+    def calcConditionalStats(self, by='month', read_vars=None, obs='flux',
+                             met='met', **kwargs):
+        """Calculate the statistics in plumber.stats.calcAllStats for all
+           sources against the observations obs at each site, conditional on
+           month, season, hour of day or regime. The group codes are
+           calculated once per site on the time axis of the observations and
+           all groups are evaluated in a single grouped pass (see
+           plumber.stats.groupCodes and plumber.stats.calcGroupedStats). As
+           in calcStats, only sources in the current shard are included and
+           only time steps at which both the source and the observations are
+           valid are used. The regimes 'daytime' and 'swdown' are based on
+           SWdown in the meteorological forcing met. Additional keyword
+           arguments are passed to plumber.stats.groupCodes. The results are
+           returned as a table with one row per site, source, group, variable
+           and metric"""
+        if read_vars is None:
+            read_vars = self.cfg.get('analysis', {}).get('stats_vars')
+        if isinstance(read_vars, str):
+            read_vars = [read_vars]
+        observations = self.cfg['observations']['observations']
+        tables = []
+        for site in sorted(self.data):
+            if obs not in self.data[site]:
+                continue
+            sources = [x for x in sorted(self.data[site])
+                       if x not in observations and self.inShard(site, x)]
+            if not sources:
+                continue
+            index = self.validity[site][obs].index
+            forcing = None
+            if by in ('daytime', 'swdown') and met in self.data[site]:
+                forcing = self.select(site, met, 'SWdown', stack=True)
+                forcing.columns = forcing.columns.get_level_values(-1)
+            codes, labels = plumberstats.groupCodes(index, by, forcing,
+                                                    **kwargs)
+            codes = pd.Series(codes, index=index)
+            for source in sources:
+                variables = [x for x in self.data[site][source].columns
+                             if x in self.data[site][obs].columns]
+                if read_vars is not None:
+                    variables = [x for x in variables if x in read_vars]
+                if not variables or not self._sameGrid(site, source, obs):
+                    continue
+                d1, d2 = self._pairedFrames(site, source, obs, variables)
+                if not len(d1):
+                    continue
+                table = plumberstats.calcGroupedStats(
+                    d1, d2, codes.reindex(d1.index, fill_value=-1).values,
+                    labels)
+                table.insert(0, 'source', source)
+                table.insert(0, 'site', site)
+                tables.append(table)
+                logging.debug('Calculated stats by %s for %s %s', by, site,
+                              source)
+        if not tables:
+            return pd.DataFrame(columns=['site', 'source', 'group'] +
+                                results_columns[2:])
+        return pd.concat(tables, ignore_index=True)
 
-    def plot(self, section):
-        """Make plot according to the information in self.cfg[section]"""
+    def calcSpectra(self, site, var, sources=None, obs='flux',
+                    maxlag=3*spectral.steps_per_day, nbands=50):
+        """Power spectra, coherence and lagged cross-correlation of var for
+           sources against the observations obs at site, see
+           plumber.spectral.spectralAnalysis. sources defaults to all models
+           at the site that have var. All sources are transformed together.
+           The results are cached in self.spectra and are recalculated only
+           if the data change"""
+        if sources is None:
+            sources = [x for x in sorted(self.data[site])
+                       if x not in self.cfg['observations']['observations']]
+        sources = [x for x in _asList(sources, None) if x != obs]
+        keys = self.selectKeys(site, [obs] + sources, var)
+        if not keys or keys[0][1] != obs:
+            raise ValueError('No {} observations of {} at {}'.
+                             format(obs, var, site))
+        sources = [x[1] for x in keys[1:]]
+        key = (site, var, obs, tuple(sources), maxlag, nbands)
+        fingerprint = [self.atomFingerprint(*x) for x in keys]
+        try:
+            if self.spectra[key][0] == fingerprint:
+                return self.spectra[key][1]
+        except KeyError:
+            pass
+        df = self.select(site, [obs] + sources, var, stack=True)
+        df.columns = df.columns.get_level_values(1)
+        result = spectral.spectralAnalysis(df, obs, maxlag, nbands)
+        self.spectra[key] = (fingerprint, result)
+        logging.debug('Calculated spectra of %s for %s', var, site)
+        return result
+
+    def detectTimeShifts(self, sources=None, read_vars=None, obs='flux',
+                         apply=False, min_agreement=0.5, min_lag=20.):
+        """Estimate the time offset of each model against the observations
+           obs from the mean diurnal cycles of all variables they share at
+           all sites. The cycles are based on the time steps at which both
+           are valid and are compared with a circular cross-correlation
+           that is calculated for all models, sites and variables in a
+           single batched FFT (see plumber.spectral). The correlation curves
+           of each model are averaged over its sites and variables and the
+           lag of the maximum is refined to a fraction of a time step.
+
+           The offset is detected in the data as ingested, so the suggested
+           tshift is the current tshift (from the [TSHIFTS] section) minus
+           the detected lag, rounded to whole time steps so that the model
+           stays on the time grid of the observations. A model whose output
+           is late relative to the observations gets a negative shift. Lags
+           shorter than min_lag do not change the tshift. If apply is True, the
+           suggested shifts of models with an agreement of at least
+           min_agreement are stored in self.cfg['tshifts'] and the models
+           are ingested again.
+
+        Parameters
+        ----------
+        Default:
+            sources : list
+                models to check (default=all loaded models)
+            read_vars : list
+                variables to compare (default=stats_vars in the [ANALYSIS]
+                section or all variables shared with obs)
+            obs : string
+                observations to compare against (default='flux')
+            apply : bool
+                apply the suggested shifts (default=False)
+            min_agreement : float
+                minimum agreement for a shift to be applied (default=0.5)
+            min_lag : float
+                minimum absolute lag (minutes) for a shift to be suggested
+                (default=20, two thirds of a time step)
+
+        Returns
+        -------
+        shifts : pandas dataframe
+            table indexed by source with the detected lag (minutes), the
+            current and suggested tshift (minutes), the correlation of the
+            averaged diurnal cycles at the detected lag, the agreement (the
+            fraction of sites and variables whose own lag is within a
+            quarter of a time step of the detected lag) and the number of
+            sites and variables
+        """
+        if read_vars is None:
+            read_vars = self.cfg.get('analysis', {}).get('stats_vars')
+        read_vars = _asList(read_vars, None)
+        observations = self.cfg['observations']['observations']
+        tshifts = self.cfg.get('tshifts', {})
+        if sources is None:
+            sources = sorted(set([x for site in self.data
+                                  for x in self.data[site]
+                                  if x not in observations]))
+        sources = _asList(sources, None)
+        step = 24*60 / spectral.steps_per_day
+        cycles = []
+        members = []
+        for i, source in enumerate(sources):
+            for site in sorted(self.data):
+                if source not in self.data[site] or \
+                   obs not in self.data[site]:
+                    continue
+                keys = self.selectKeys(site, [source, obs], read_vars)
+                variables = [x[2] for x in keys if x[1] == source and
+                             (site, obs, x[2]) in keys]
+                if not variables or not self._sameGrid(site, source, obs):
+                    continue
+                d1, d2 = self._pairedFrames(site, source, obs, variables)
+                cycles.append((spectral.diurnalComposite(d1).values.T,
+                               spectral.diurnalComposite(d2).values.T))
+                members.extend([i] * len(variables))
+        columns = ['lag', 'tshift', 'suggested_tshift', 'correlation',
+                   'agreement', 'count']
+        shifts = pd.DataFrame(np.nan, index=pd.Index(sources, name='source'),
+                              columns=columns)
+        shifts['tshift'] = [tshifts.get(x.lower(), 0) or 0 for x in sources]
+        shifts['count'] = 0
+        if cycles:
+            x = np.vstack([c[0] for c in cycles])
+            y = np.vstack([c[1] for c in cycles])
+            members = np.asarray(members)
+            correlation = spectral.diurnalCorrelation(x, y)
+            lags = spectral.peakLag(correlation)[0]
+            ok = ~np.isnan(correlation).any(axis=1)
+            for i, source in enumerate(sources):
+                selected = ok & (members == i)
+                if not selected.any():
+                    continue
+                lag, peak = spectral.peakLag(
+                    correlation[selected].mean(axis=0))
+                difference = abs((lags[selected] - lag +
+                                  spectral.steps_per_day/2.) %
+                                 spectral.steps_per_day -
+                                 spectral.steps_per_day/2.)
+                shifts.loc[source, 'lag'] = lag * step
+                shifts.loc[source, 'correlation'] = peak
+                shifts.loc[source, 'agreement'] = (difference <= 0.25).mean()
+                shifts.loc[source, 'count'] = selected.sum()
+        correction = step * (shifts['lag'] / step).round()
+        correction[shifts['lag'].abs() < min_lag] = 0
+        shifts['suggested_tshift'] = shifts['tshift'] - correction + 0.
+        for source, row in shifts.iterrows():
+            logging.info('Time offset of %s: %.1f minutes (suggested tshift '
+                         '%s, agreement %.2f)', source, row['lag'],
+                         row['suggested_tshift'], row['agreement'])
+        if apply:
+            self._applyTimeShifts(shifts, min_agreement)
+        return shifts
+
+    def inShard(self, site, source=None):
+        """Determine whether site (and source) belong to the current shard.
+           Work is partitioned round-robin over the sorted sites (if
+           self.shard_by is 'site') or over the sorted (site, model) pairs (if
+           self.shard_by is 'atom'). In the latter case, observations belong
+           to every shard that has a model at that site"""
+        if self.shard is None:
+            return True
+        shard, nshards = self.shard
+        sites = sorted(self.cfg['sites']['sites'])
+        if self.shard_by == 'site' or source is None:
+            return utils.shardOf(site, sites, nshards) == shard
+        models = sorted(utils.flatten(list(self.cfg['sources'].values())))
+        if source in self.cfg['observations']['observations']:
+            return any([self.inShard(site, x) for x in models])
+        atoms = [(x, y) for x in sites for y in models]
+        return utils.shardOf((site, source), atoms, nshards) == shard
+
+    def categorySources(self, category):
+        """Return the sources that belong to category. category is one of the
+           keys in the [SOURCES] section of the configuration file,
+           'observations' or one of the observation types (e.g. 'flux')"""
+        if category in self.cfg['sources']:
+            sources = self.cfg['sources'][category]
+        elif category == 'observations':
+            sources = self.cfg['observations']['observations']
+        elif category in \
+                utils.flatten(self.cfg['observations']['observations']):
+            sources = [category]
+        else:
+            raise ValueError('Unknown category: {}'.format(category))
+        if isinstance(sources, str):
+            sources = [sources]
+        return list(sources)
+
+    def select(self, sites=None, sources=None, read_vars=None, time=None,
+               category=None, stack=False):
+        """Select time series from the loaded data without copying them
+
+        Parameters
+        ----------
+        Default:
+            sites : string or list
+                site(s) to select (default=all loaded sites)
+            sources : string or list
+                source(s) to select (default=all loaded sources)
+            read_vars : string or list
+                variable(s) to select (default=all variables)
+            time : slice, string or int
+                period to select, e.g. slice('2005-06', '2005-08') or 2005.
+                Partial date strings are allowed (default=entire record)
+            category : string
+                only select sources in this category (see categorySources)
+            stack : bool
+                combine the selection into a single dataframe
+                (default=False)
+
+        Returns
+        -------
+        selection : OrderedDict or pandas dataframe
+            dictionary of pandas Series keyed by (site, source, variable).
+            The Series are views of self.data (for data that are in memory),
+            so do not modify them. If stack is True, the Series are combined
+            into a single dataframe with (site, source, variable) columns,
+            which means that they are aligned in time and copied.
+
+        Sites, sources and variables that are not available are silently
+        skipped. It is up to the user to check for completeness.
+        """
+        time = _timeSlice(time)
+        selection = OrderedDict()
+        for site, source, var in self.selectKeys(sites, sources, read_vars,
+                                                 category):
+            selection[(site, source, var)] = \
+                _selectSeries(self.data[site][source], var, time)
+        if stack:
+            if not selection:
+                return pd.DataFrame()
+            return pd.concat(list(selection.values()), axis=1,
+                             keys=list(selection.keys()),
+                             names=results_columns[:3])
+        return selection
+
+    def selectKeys(self, sites=None, sources=None, read_vars=None,
+                   category=None):
+        """Return the (site, source, variable) keys that select() would
+           return, without touching the data"""
+        sites = _asList(sites, sorted(self.data))
+        if category is not None:
+            members = self.categorySources(category)
+        keys = []
+        for site in sites:
+            if site not in self.data:
+                continue
+            for source in _asList(sources, sorted(self.data[site])):
+                if source not in self.data[site]:
+                    continue
+                if category is not None and source not in members:
+                    continue
+                columns = self.data[site][source].columns
+                for var in _asList(read_vars, list(columns)):
+                    if var in columns:
+                        keys.append((site, source, var))
+        return keys
+
+    def setShard(self, shard, nshards, by='site'):
+        """Restrict ingest, stats and plotting to shard out of nshards, with
+           shard in [0, nshards). by is either 'site' or 'atom' (a single
+           site and model). Use setShard(None, None) to remove the
+           restriction"""
+        if shard is None:
+            self.shard = None
+            return
+        if by not in ('site', 'atom'):
+            raise ValueError('Shards are either by site or by atom: {}'.
+                             format(by))
+        if not 0 <= shard < nshards:
+            raise ValueError('Invalid shard {}/{}'.format(shard, nshards))
+        self.shard = (shard, nshards)
+        self.shard_by = by
+
+    def plot(self, section, jobs=None):
+        """Make plot according to the information in self.cfg[section]. The
+           plot functions add derived entries to the section; these are
+           discarded afterwards so that the configuration is unchanged. For
+           batch plots, jobs restricts the figures that are rendered to a
+           subset of plumber.plot.getBatchJobs"""
         info = self.cfg[section]
         plotf = getattr(plumberplot, info['plot'])
-        plotf(self, section)
+        self.cfg[section] = copy.deepcopy(info)
+        try:
+            if jobs is None:
+                plotf(self, section)
+            else:
+                plotf(self, section, jobs=jobs)
+        finally:
+            self.cfg[section] = info
 
-    def plotAll(self):
+    def plotAll(self, force=False, dry_run=False):
         """Process all plots in self.cfg. This is determined by all sections
-           starting with 'plot_' other than 'plot_defaults'"""
+           starting with 'plot_' other than 'plot_defaults'. In sharded mode,
+           only the sections that belong to the current shard are plotted.
+
+           A fingerprint of the section's configuration and of the data that
+           go into each output file is stored next to that file (see
+           plotStatus) and files are only plotted if their fingerprint has
+           changed, unless force is True. Batch plots only render the
+           figures that are out of date. If dry_run is True, nothing is
+           plotted, but the files that would be plotted are listed.
+
+           Returns a list of (section, reason) for the sections that were
+           (or would be) plotted, where reason is 'new' if any of the
+           section's files is new and 'changed' or 'forced' otherwise"""
         plotsections = [x for x in self.cfg
                         if re.match(u'plot_', x) and not x == 'plot_defaults']
+        plotted = []
         for section in plotsections:
-            self.plot(section)
+            if not self.sectionInShard(section):
+                logging.info('Skipping %s: not part of shard %s',
+                             section, self.shard)
+                continue
+            status = self.plotStatus(section)
+            if force:
+                status = [(x[0], x[1], x[2] or 'forced', x[3])
+                          for x in status]
+            stale = [x for x in status if x[2] is not None]
+            if not stale:
+                logging.info('Skipping %s: up to date', section)
+                continue
+            reasons = set([x[2] for x in stale])
+            plotted.append((section, 'new' if 'new' in reasons
+                            else reasons.pop()))
+            if dry_run:
+                for filename, _, reason, _ in stale:
+                    print('{}: {} ({})'.format(section, filename, reason))
+                continue
+            if self.cfg[section]['plot'] in plumberplot.batch_plots:
+                self.plot(section, jobs=[x[3] for x in stale])
+            else:
+                self.plot(section)
+            for filename, fingerprint, _, _ in stale:
+                with open(_fingerprintFile(filename), 'w') as f:
+                    f.write(fingerprint)
+        return plotted
+
+    def plotStatus(self, section):
+        """Return the status of each file that a plot section writes as a list
+           of (filename, fingerprint, reason, job), where reason is 'new' or
+           'changed' if the file needs to be plotted and None if it is up to
+           date and job is the entry of plumber.plot.getBatchJobs for batch
+           plots (None otherwise). The fingerprint covers the section and the
+           plot defaults, the source of the plot module and the (site,
+           source, variable) data that go into the file"""
+        info = self.cfg[section]
+        h = hashlib.sha1()
+        h.update(json.dumps([info, self.cfg.get('plot_defaults', {})],
+                            sort_keys=True, default=str).encode('utf-8'))
+        h.update(_moduleFingerprint(plumberplot).encode('utf-8'))
+        if info['plot'] in plumberplot.batch_plots:
+            outputs = [(x[2], self.selectKeys(x[0], x[1], info['read_vars']),
+                        x) for x in plumberplot.getBatchJobs(self, section)]
+        else:
+            outputs = [(info['plotfilename'], self.sectionKeys(section),
+                        None)]
+        status = []
+        for filename, keys, job in outputs:
+            hfile = h.copy()
+            for key in keys:
+                hfile.update(self.atomFingerprint(*key).encode('utf-8'))
+            fingerprint = hfile.hexdigest()
+            fpfile = _fingerprintFile(filename)
+            reason = None
+            if not os.path.exists(filename) or not os.path.exists(fpfile):
+                reason = 'new'
+            else:
+                with open(fpfile) as f:
+                    if f.read().strip() != fingerprint:
+                        reason = 'changed'
+            status.append((filename, fingerprint, reason, job))
+        return status
+
+    def sectionKeys(self, section):
+        """Return the (site, source, variable) keys that a plot section reads.
+           Sections without site or source read all loaded sites or
+           sources"""
+        info = self.cfg[section]
+        return self.selectKeys(info.get('site'), _sectionSources(info, None),
+                               info.get('read_vars'))
+
+    def atomFingerprint(self, site, source, var):
+        """Fingerprint of the data for a single site, source and variable.
+           Fingerprints are cached until the site and source are ingested or
+           restored again"""
+        key = (site, source, var)
+        if key not in self.fingerprints:
+            data = self.data[site][source]
+            h = hashlib.sha1()
+            if isinstance(data, io.ChunkedTimeSeries):
+                h.update(data.fingerprint(var).encode('utf-8'))
+            else:
+                series = data[var]
+                h.update(str((series.index[0], series.index[-1],
+                              len(series))).encode('utf-8'))
+                h.update(np.ascontiguousarray(series.values).view(np.uint8))
+            self.fingerprints[key] = h.hexdigest()
+        return self.fingerprints[key]
+
+    def sectionInShard(self, section):
+        """Determine whether a plot section belongs to the current shard. A
+           section belongs to a shard if the shard holds all the data for the
+           section. Sections that are not restricted to a single site (or, if
+           the shards are by atom, to specific sources) do not belong to any
+           shard and should be plotted after merging"""
+        if self.shard is None:
+            return True
+        info = self.cfg[section]
+        # batch plots only render the sites that belong to the shard
+        if info['plot'] in plumberplot.batch_plots:
+            return True
+        site = info.get('site')
+        if not isinstance(site, str):
+            return False
+        sources = _sectionSources(info, None)
+        if sources is None:
+            # a shard by atom only holds some of the models at a site
+            return self.shard_by == 'site' and self.inShard(site)
+        return all([self.inShard(site, x) for x in sources])
 
     def reparseConfig(self, configfile):
         """Parse a new configuration file without reloading or restoring the
            data. Use at your own risk, because it is not guaranteed that your
            data and your configuration will be in-sync"""
+        self.configfile = configfile
         if self.configfile:
             self.cfg = io.parseConfig(self.configfile)
 
@@ -114,9 +968,12 @@ class PlumberAnalysis(object):
         # pickle self.data as separate files. Since we do not restore data
         # by default, we loop over the data_dict
         self.data = {}
+        self.aggregates = {}
+        self.validity = {}
         for site in self.data_dict:
             for source in self.data_dict[site]:
-                self.restoreDataAtom(path, site, source)
+                if self.inShard(site, source):
+                    self.restoreDataAtom(path, site, source)
 
     def restoreDataAtom(self, path, site, source):
         """Unpickle the data for a single site and source"""
@@ -125,6 +982,25 @@ class PlumberAnalysis(object):
         pfile = os.path.join(path, '{}_{}.pickle'.format(site, source))
         with open(pfile, 'rb') as f:
             self.data[site][source] = pickle.load(f)
+        self._clearFingerprints(site, source)
+        pfile = os.path.join(path, '{}_{}_aggregates.pickle'.format(site,
+                                                                   source))
+        if os.path.exists(pfile):
+            if site not in self.aggregates:
+                self.aggregates[site] = {}
+            with open(pfile, 'rb') as f:
+                self.aggregates[site][source] = pickle.load(f)
+        else:
+            self._updateAggregates(site, source)
+        pfile = os.path.join(path, '{}_{}_validity.pickle'.format(site,
+                                                                 source))
+        if os.path.exists(pfile):
+            if site not in self.validity:
+                self.validity[site] = {}
+            with open(pfile, 'rb') as f:
+                self.validity[site][source] = pickle.load(f)
+        else:
+            self._updateValidity(site, source)
         if site not in self.data_dict:
             self.data_dict[site] = []
         if source not in self.data_dict[site]:
@@ -136,29 +1012,436 @@ class PlumberAnalysis(object):
            files will be placed in path, which will be created if it does not
            exist. If it already exists, then any files in path will be
            overwritten."""
+        self._storeInstance(path)
+        # pickle self.data, self.aggregates and self.validity as separate
+        # files
+        for site in self.data:
+            for source in self.data[site]:
+                storeAtom(path, site, source, self.data[site][source],
+                          self.aggregates.get(site, {}).get(source),
+                          self.validity.get(site, {}).get(source))
+
+    @classmethod
+    def merge(cls, paths, outpath):
+        """Merge the stored analyses in paths (typically one for each shard)
+           into a single stored analysis in outpath. The data and aggregates
+           are copied, the results tables are combined and the class instance
+           is written without shard information. Atoms that occur in more than
+           one path (such as the observations when sharding by atom) are taken
+           from the first path they occur in"""
+        try:
+            os.makedirs(outpath)
+        except os.error:
+            pass
+        merged = None
+        results = []
+        shards = set()
+        for path in paths:
+            p = cls.restore(path)
+            data_dict = p.data_dict
+            if p.results is not None:
+                results.append(p.results)
+            if merged is None:
+                merged = p
+                merged.data_dict = {}
+                merged.results = None
+            if p.shard is not None:
+                shards.add(p.shard)
+            for site in data_dict:
+                for source in data_dict[site]:
+                    if source in merged.data_dict.get(site, []):
+                        logging.debug('Skipping duplicate %s %s in %s',
+                                      site, source, path)
+                        continue
+                    for fname in ['{}_{}.pickle'.format(site, source),
+                                  '{}_{}_aggregates.pickle'.format(site,
+                                                                   source),
+                                  '{}_{}_validity.pickle'.format(site,
+                                                                 source)]:
+                        pfile = os.path.join(path, fname)
+                        if os.path.exists(pfile):
+                            utils.copy(pfile, os.path.join(outpath, fname))
+                    if site not in merged.data_dict:
+                        merged.data_dict[site] = []
+                    merged.data_dict[site].append(source)
+        if merged is None:
+            raise ValueError('Nothing to merge')
+        nshards = set([x[1] for x in shards])
+        if len(nshards) > 1:
+            raise ValueError('Inconsistent number of shards: {}'.
+                             format(sorted(nshards)))
+        if nshards and len(shards) != list(nshards)[0]:
+            logging.warning('Merging %d out of %d shards', len(shards),
+                            list(nshards)[0])
+        if results:
+            merged.results = pd.concat(results).\
+                drop_duplicates(results_columns[:-1]).\
+                set_index(results_columns[:-1]).sort_index().reset_index()
+        merged.shard = None
+        merged._storeInstance(outpath)
+        return merged
+
+    def _addAtom(self, site, source, data, aggregates=None, index=None):
+        """Add the data for site and source that have been read elsewhere,
+           together with their aggregates and validity index. These are
+           rebuilt if they are not provided"""
+        if site not in self.data:
+            self.data[site] = {}
+            self.data_dict[site] = []
+        self.data[site][source] = data
+        self._clearFingerprints(site, source)
+        if aggregates is not None:
+            self.aggregates.setdefault(site, {})[source] = aggregates
+        else:
+            self._updateAggregates(site, source)
+        if index is not None:
+            self.validity.setdefault(site, {})[source] = index
+        else:
+            self._updateValidity(site, source)
+        if source not in self.data_dict[site]:
+            self.data_dict[site].append(source)
+
+    def _applyTimeShifts(self, shifts, min_agreement):
+        """Store the suggested tshifts (see detectTimeShifts) in
+           self.cfg['tshifts'] and ingest the affected models again with the
+           same variables and chunksize. Models in a combined file (see
+           combinedTemplate) are read again from that file"""
+        if 'tshifts' not in self.cfg:
+            self.cfg['tshifts'] = {}
+        changed = shifts[(shifts['agreement'] >= min_agreement) &
+                         (shifts['suggested_tshift'] != shifts['tshift'])]
+        for source, row in changed.iterrows():
+            tshift = int(row['suggested_tshift'])
+            self.cfg['tshifts'][source.lower()] = tshift
+            logging.info('Applied tshift %d to %s', tshift, source)
+        for site, infile, tshift, sources, combined in self.atomGroups():
+            sources = [x for x in sources if x in changed.index and
+                       x in self.data.get(site, {})]
+            if not sources:
+                continue
+            if combined:
+                read_vars = [list(self.data[site][x].columns)
+                             for x in sources]
+                dfs = io.ingestCombined(infile, sources,
+                                        sorted(set(utils.flatten(read_vars))),
+                                        tshift=tshift)
+                for source, variables in zip(sources, read_vars):
+                    self._addAtom(site, source, dfs[source][variables])
+                continue
+            data = self.data[site][sources[0]]
+            chunksize = None
+            if isinstance(data, io.ChunkedTimeSeries):
+                chunksize = data.chunksize
+            self.ingest(site, sources[0], infile,
+                        read_vars=list(data.columns), tshift=tshift,
+                        chunksize=chunksize)
+
+    def _clearFingerprints(self, site, source):
+        """Remove the cached fingerprints for site and source"""
+        for key in [x for x in self.fingerprints if x[:2] == (site, source)]:
+            del self.fingerprints[key]
+
+    def _pairedFrames(self, site, source, obs, variables):
+        """Select variables for source and for the observations obs at site,
+           with the variable names as columns, and mask them to the time
+           steps at which both are valid (see validity.pairwiseValid).
+           source and obs must be on the same time grid (see _sameGrid)"""
+        d1 = self.select(site, source, variables, stack=True)
+        d2 = self.select(site, obs, variables, stack=True)
+        d1.columns = d1.columns.get_level_values(-1)
+        d2.columns = d2.columns.get_level_values(-1)
+        return validity.pairwiseValid(d1, d2, self.validity[site][source],
+                                      self.validity[site][obs], variables)
+
+    def _sameGrid(self, site, source, obs):
+        """Check that the time steps of source and obs at site coincide, which
+           is not the case if source was shifted by a tshift that is not a
+           multiple of the time step. A warning is logged if they do not"""
+        offset = (self.validity[site][source].start -
+                  self.validity[site][obs].start) / validity.freq
+        if offset % 1:
+            logging.warning('%s %s is not on the time grid of %s (offset of '
+                            '%.2f time steps), check its tshift', site,
+                            source, obs, offset)
+            return False
+        return True
+
+    def _storeInstance(self, path):
+        """Pickle the class instance (without the data) in path, which will
+           be created if it does not exist"""
         # Create path
         try:
             os.makedirs(path)
         except os.error:
             pass
         # pickle the class instance
-        pfile = os.path.join(path, 'class_instance.pickle')
-        with open(pfile, 'wb') as f:
-            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
-        # pickle self.data as separate files
-        for site in self.data:
-            for source in self.data[site]:
-                pfile = os.path.join(path, '{}_{}.pickle'.format(site, source))
-                with open(pfile, 'wb') as f:
-                    pickle.dump(self.data[site][source], f,
-                                pickle.HIGHEST_PROTOCOL)
+        _dumpPickle(self, os.path.join(path, 'class_instance.pickle'))
 
-if __name__ == '__main__':
-    # get configuration file from command-line
+    def _updateValidity(self, site, source):
+        """Rebuild the validity index for a single site and source after its
+           data have changed"""
+        data = self.data[site][source]
+        if site not in self.validity:
+            self.validity[site] = {}
+        if isinstance(data, io.ChunkedTimeSeries):
+            self.validity[site][source] = \
+                validity.ValidityIndex.fromChunks(data.iterChunks())
+        else:
+            self.validity[site][source] = validity.ValidityIndex(data)
+
+    def _updateAggregates(self, site, source):
+        """Rebuild the aggregates for a single site and source after its
+           data have changed. Aggregates that exist for the atom are always
+           rebuilt, others only if aggregate_levels is set in the
+           configuration"""
+        try:
+            pyramid_levels = list(self.aggregates[site][source])
+        except KeyError:
+            pyramid_levels = self.aggregateLevels()
+        if pyramid_levels is not None:
+            self.buildAggregates(site, source, pyramid_levels)
+
+
+def storeAtom(path, site, source, data, aggregates=None, validity=None):
+    """Pickle the data (and aggregates and validity index) for a single site
+       and source in path"""
+    _dumpPickle(data, os.path.join(path, '{}_{}.pickle'.format(site,
+                                                               source)))
+    if aggregates is not None:
+        _dumpPickle(aggregates,
+                    os.path.join(path, '{}_{}_aggregates.pickle'.
+                                 format(site, source)))
+    if validity is not None:
+        _dumpPickle(validity,
+                    os.path.join(path, '{}_{}_validity.pickle'.
+                                 format(site, source)))
+
+
+def _dumpPickle(obj, pfile):
+    """Pickle obj in pfile. The pickle is written to a temporary file that
+       then replaces pfile, so that a failed write does not leave pfile
+       truncated and files that are hard-linked to pfile (see merge) keep
+       their contents"""
+    tmpfile = '{}.{}.tmp'.format(pfile, os.getpid())
+    try:
+        with open(tmpfile, 'wb') as f:
+            pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpfile, pfile)
+    finally:
+        # only left over if the write failed
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+
+class _AtomWriter(threading.Thread):
+    """Background thread that stores atoms (see storeAtom) in the order in
+       which they are put. At most one atom waits in the queue, so put()
+       blocks while the previous atom is still being written. Errors in the
+       writer are raised again in the calling thread"""
+
+    def __init__(self, path):
+        super(_AtomWriter, self).__init__()
+        self.daemon = True
+        self.path = path
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        try:
+            os.makedirs(path)
+        except os.error:
+            pass
+        self.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                storeAtom(self.path, *item)
+                logging.debug('Stored %s %s (peak memory %.0f MB)', item[0],
+                              item[1], utils.peakMemory())
+            except Exception as err:
+                self.error = err
+
+    def put(self, site, source, data, aggregates=None, validity=None):
+        self._check()
+        self.queue.put((site, source, data, aggregates, validity))
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        self._check()
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+
+def _readAtoms(infile, sources, combined, read_vars, tshift, chunksize,
+               pyramid_levels):
+    """Read the data for one or more sources from infile (a combined file if
+       combined is True, see plumber.io.ingestCombined) and build their
+       aggregates and validity indexes. read_vars and pyramid_levels are lists
+       with an entry for each source. This runs in a worker process of
+       PlumberAnalysis.ingestRequired, so errors are returned rather than
+       raised, which allows the caller to report the file that failed.
+       Otherwise a list with (data, aggregates, validity) for each source is
+       returned, with None for sources that have none of their read_vars"""
     try:
-        configfile = sys.argv[1]
-    except IndexError:
-        sys.exit('Usage: {} <configuration file>'.format(sys.argv[0]))
+        if combined:
+            union = 'all'
+            if 'all' not in read_vars:
+                union = sorted(set(utils.flatten(read_vars)))
+            dfs = io.ingestCombined(infile, sources, union, tshift=tshift)
+            data = []
+            for source, variables in zip(sources, read_vars):
+                df = dfs[source]
+                if variables != 'all':
+                    df = df[[x for x in df.columns if x in variables]]
+                data.append(df)
+        else:
+            data = [io.ingest(infile, read_vars[0], tshift=tshift,
+                              chunksize=chunksize)]
+    except ValueError as err:
+        return err
+    atoms = []
+    for df, levels in zip(data, pyramid_levels):
+        if not len(df.columns):
+            atoms.append(None)
+            continue
+        pyramid = None
+        if levels is not None:
+            pyramid = aggregate.buildPyramid(df, levels)
+        if isinstance(df, io.ChunkedTimeSeries):
+            index = validity.ValidityIndex.fromChunks(df.iterChunks())
+        else:
+            index = validity.ValidityIndex(df)
+        atoms.append((df, pyramid, index))
+    return atoms
+
+
+def _asList(x, default):
+    """Return x as a list or default if x is None"""
+    if x is None:
+        return default
+    if isinstance(x, str):
+        return [x]
+    return list(x)
+
+
+def _sectionSources(info, default):
+    """Sources that a plot section reads: its source entry (or default if
+       it has none) and, for plotSpectra, the observations it compares
+       against"""
+    sources = _asList(info.get('source'), default)
+    if sources is not None and info.get('plot') == 'plotSpectra':
+        obs = info.get('obs', 'flux')
+        if obs not in sources:
+            sources = sources + [obs]
+    return sources
+
+
+def _moduleFingerprint(module):
+    """Fingerprint of the source file of module"""
+    if module.__name__ not in _module_fingerprints:
+        with open(module.__file__, 'rb') as f:
+            _module_fingerprints[module.__name__] = \
+                hashlib.sha1(f.read()).hexdigest()
+    return _module_fingerprints[module.__name__]
+
+
+def _fingerprintFile(filename):
+    """Name of the file that holds the fingerprint of a plot file"""
+    return filename + '.fingerprint'
+
+
+def _selectSeries(data, var, time):
+    """Select var for the period time (a slice or None) from data"""
+    if isinstance(data, io.ChunkedTimeSeries):
+        start = end = None
+        if time is not None:
+            window = data.index.slice_indexer(time.start, time.stop)
+            window = data.index[window]
+            if not len(window):
+                return pd.Series([], index=window, name=var, dtype=float)
+            start = window[0]
+            end = window[-1]
+        return data.toDataFrame([var], start, end)[var]
+    series = data[var]
+    if time is None:
+        return series
+    return series.loc[time]
+
+
+def _timeSlice(time):
+    """Convert time to a slice that can be used to index a DatetimeIndex"""
+    if time is None or isinstance(time, slice):
+        return time
+    return slice(str(time), str(time))
+
+
+if __name__ == '__main__':
+    # get configuration file and tasks from command-line
+    parser = argparse.ArgumentParser(description='Analysis of the PLUMBER '
+                                     'dataset')
+    parser.add_argument('configfile', help='configuration file')
+    parser.add_argument('--restore', metavar='PATH',
+                        help='restore a stored analysis instead of ingesting')
+    parser.add_argument('--ingest', action='store_true',
+                        help='ingest all sites and sources')
+    parser.add_argument('--required', action='store_true',
+                        help='only ingest the sites, sources and variables '
+                        'that are needed for --stats and --plot')
+    parser.add_argument('--explain', action='store_true',
+                        help='list what --required would ingest and why')
+    parser.add_argument('--workers', metavar='N', type=int,
+                        help='number of processes for --required')
+    parser.add_argument('--tshifts', choices=['suggest', 'apply'],
+                        help='detect the time offset of each model and '
+                        'print or apply the suggested tshifts')
+    parser.add_argument('--stats', action='store_true',
+                        help='calculate stats for all sources')
+    parser.add_argument('--plot', action='store_true',
+                        help='make all plots in the configuration file')
+    parser.add_argument('--force', action='store_true',
+                        help='plot all sections, even if they are up to date')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='list the sections that would be plotted')
+    parser.add_argument('--store', metavar='PATH',
+                        help='store the analysis (or the merged analysis)')
+    parser.add_argument('--stream', action='store_true',
+                        help='store each site and source in the --store '
+                        'path as soon as it is ingested')
+    parser.add_argument('--shard', metavar='i/N', type=utils.parseShard,
+                        help='only process shard i (0 <= i < N) of N')
+    parser.add_argument('--shard-by', choices=['site', 'atom'],
+                        default='site',
+                        help='partition by site or by (site, source)')
+    parser.add_argument('--serve', metavar='ADDRESS',
+                        help='serve the --restore path read-only on '
+                        'ADDRESS (host:port or the path of a Unix socket)')
+    parser.add_argument('--merge', metavar='PATH', nargs='+',
+                        help='merge stored shards into the --store path')
+    args = parser.parse_args()
+    configfile = args.configfile
+    if args.merge and not args.store:
+        parser.error('--merge requires --store')
+    if args.merge and (args.restore or args.ingest or args.required or
+                       args.explain or args.stream or args.shard or
+                       args.tshifts or args.stats or args.serve):
+        parser.error('--merge can only be combined with --store, --plot, '
+                     '--dry-run and --force')
+    if args.stream and (not args.store or not args.ingest):
+        parser.error('--stream requires --ingest and --store')
+    if args.stream and (args.stats or args.plot):
+        parser.error('--stream cannot be combined with --stats or --plot')
+    if args.serve and not args.restore:
+        parser.error('--serve requires --restore')
+    if args.required and (args.stream or not args.ingest):
+        parser.error('--required requires --ingest and cannot be combined '
+                     'with --stream')
 
     # parse configuration file to get logging info
     cfgparser = \
@@ -172,6 +1455,9 @@ if __name__ == '__main__':
     # does not exist
     logfile = cfgparser.get('LOGGING', 'logfile')
     if logfile:
+        # each shard gets its own logfile
+        if args.shard:
+            logfile = '{}.shard_{}_of_{}'.format(logfile, *args.shard)
         try:
             loglevel = cfgparser.get('LOGGING', 'loglevel').upper()
         except AttributeError:
@@ -183,7 +1469,44 @@ if __name__ == '__main__':
         logger = logging.getLogger()
         logger.disabled = True
 
-    b = PlumberAnalysis(configfile)
+    if args.merge:
+        b = PlumberAnalysis.merge(args.merge, args.store)
+        if args.plot or args.dry_run:
+            # the sections that the shards left out (see sectionInShard)
+            # need the merged data. Sections that the shards plotted are up
+            # to date and are skipped
+            b.reparseConfig(configfile)
+            b.restoreData(args.store)
+            b.plotAll(force=args.force, dry_run=args.dry_run)
+    else:
+        if args.restore:
+            b = PlumberAnalysis.restore(args.restore)
+            b.reparseConfig(configfile)
+        else:
+            b = PlumberAnalysis(configfile)
+        if args.shard:
+            b.setShard(args.shard[0], args.shard[1], by=args.shard_by)
+        if args.restore:
+            b.restoreData(args.restore)
+        needed = dict(plots=args.plot or args.dry_run, stats=args.stats)
+        if args.explain:
+            b.explain(**needed)
+        if args.stream:
+            b.ingestAll(stream_to=args.store)
+        elif args.required:
+            b.ingestRequired(workers=args.workers, **needed)
+        elif args.ingest:
+            b.ingestAll()
+        if args.tshifts:
+            print(b.detectTimeShifts(apply=args.tshifts == 'apply'))
+        if args.stats:
+            b.calcStats()
+        if args.plot or args.dry_run:
+            b.plotAll(force=args.force, dry_run=args.dry_run)
+        if args.store and not args.stream:
+            b.store(args.store)
+        if args.serve:
+            server.serve(b, args.serve)
 
     # Shutdown logging (last act)
     logging.shutdown()
@@ -0,0 +1,407 @@
+"""
+Read-only query service for a stored plumber analysis
+
+A stored analysis (see PlumberAnalysis.store) is loaded once and served to
+any number of clients over HTTP, either on a TCP port or on a Unix socket.
+Requests are handled concurrently in threads and the encoded responses are
+kept in an LRU cache that is limited in entries and in bytes. Reads from
+chunked data (see plumber.io.ChunkedTimeSeries) go to netcdf files, which
+cannot be read from several threads at once, so queries that read them are
+serialized. The endpoints are
+
+    /keys                               (site, source, variable) keys
+    /select?sites=&sources=&read_vars=&time=&start=&end=&category=
+                                        stacked selection, see select
+    /aggregate?site=&source=&level=     stored aggregate at level
+    /stats?site=&source=&read_vars=&obs=&level=
+                                        stats, see calcAtomStats
+
+List arguments are comma-separated. time is a single period (e.g. 2003 or
+2003-07) and start and end are the (inclusive) bounds of a range, which
+can be partial dates or timestamps. Stats at a level are only calculated
+from stored aggregates, so that queries never modify the analysis. Frames
+are sent in a compact binary format (see encodeFrame): a JSON header with
+the index and column labels followed by the index and the values as numpy
+arrays. PlumberClient turns the responses back into pandas dataframes.
+"""
+from collections import OrderedDict
+import http.client
+import http.server
+import json
+import errno
+import logging
+import os
+import socket
+import socketserver
+import struct
+import threading
+import urllib.parse
+from io import BytesIO
+import numpy as np
+import pandas as pd
+
+content_type = 'application/x-plumber-frame'
+
+
+class _AnalysisServer(socketserver.ThreadingMixIn):
+    """Shared part of PlumberServer and UnixPlumberServer: handle each
+       request in a thread and cache the encoded responses"""
+    daemon_threads = True
+
+    def _setAnalysis(self, analysis, cachesize, cachebytes):
+        self.analysis = analysis
+        self.cache = _ResponseCache(cachesize, cachebytes)
+        # chunked data (see plumber.io.ChunkedTimeSeries) are read from
+        # netcdf files
+        self.chunked = any([hasattr(x, 'iterChunks')
+                            for site in analysis.data.values()
+                            for x in site.values()])
+        self._read_lock = threading.Lock()
+
+    def query(self, endpoint, args):
+        """Return the encoded response to a query from the cache or run it.
+           args is a tuple of (key, value) pairs"""
+        return self.cache.get((endpoint, args),
+                              lambda: self._query(endpoint, args))
+
+    def _query(self, endpoint, args):
+        """Run a query, one at a time if it reads chunked data"""
+        if self.chunked and endpoint in ('select', 'stats'):
+            with self._read_lock:
+                return query(self.analysis, endpoint, dict(args))
+        return query(self.analysis, endpoint, dict(args))
+
+
+class PlumberServer(_AnalysisServer, http.server.HTTPServer):
+    """Threaded HTTP server for a PlumberAnalysis instance on a TCP port"""
+
+    def __init__(self, address, analysis, cachesize=256, cachebytes=2**28):
+        self._setAnalysis(analysis, cachesize, cachebytes)
+        http.server.HTTPServer.__init__(self, address, _RequestHandler)
+
+
+class UnixPlumberServer(_AnalysisServer, socketserver.UnixStreamServer):
+    """Threaded HTTP server for a PlumberAnalysis instance on a Unix
+       socket"""
+
+    def __init__(self, path, analysis, cachesize=256, cachebytes=2**28):
+        self._setAnalysis(analysis, cachesize, cachebytes)
+        _removeStaleSocket(path)
+        socketserver.UnixStreamServer.__init__(self, path, _RequestHandler)
+
+    def server_close(self):
+        """Close the server and remove its socket file"""
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+class _ResponseCache(object):
+    """Thread-safe LRU cache of encoded responses that holds at most maxsize
+       entries and maxbytes bytes. Responses that are larger than maxbytes
+       are not cached"""
+
+    def __init__(self, maxsize, maxbytes):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, function):
+        """Return the response for key, calling function() to create it if
+           it is not in the cache. Exceptions are not cached"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        value = function()
+        with self._lock:
+            if key not in self._entries and len(value) <= self.maxbytes:
+                self._entries[key] = value
+                self.nbytes += len(value)
+                while len(self._entries) > self.maxsize or \
+                        self.nbytes > self.maxbytes:
+                    self.nbytes -= len(self._entries.popitem(last=False)[1])
+        return value
+
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+    """Handle GET requests by passing them to server.query"""
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        endpoint = url.path.strip('/')
+        args = tuple(sorted(urllib.parse.parse_qsl(url.query)))
+        try:
+            body = self.server.query(endpoint, args)
+            status = 200
+        except KeyError as err:
+            body = 'Not found: {}'.format(err).encode('utf-8')
+            status = 404
+        except (ValueError, TypeError) as err:
+            body = 'Bad request: {}'.format(err).encode('utf-8')
+            status = 400
+        self.send_response(status)
+        self.send_header('Content-Type', content_type if status == 200
+                         else 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix sockets do not have a client address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'local'
+
+    def log_message(self, format, *args):
+        logging.debug('%s: %s', self.address_string(), format % args)
+
+
+class PlumberClient(object):
+    """Client for a PlumberServer. address is 'host:port' or the path of a
+       Unix socket. All queries return pandas dataframes"""
+
+    def __init__(self, address, timeout=None):
+        self.address = address
+        self.timeout = timeout
+
+    def keys(self):
+        """List of (site, source, variable) keys"""
+        df = self.get('keys')
+        return [tuple(x) for x in df.index]
+
+    def select(self, sites=None, sources=None, read_vars=None, time=None,
+               category=None):
+        """Stacked selection with (site, source, variable) columns, see
+           PlumberAnalysis.select"""
+        start = end = None
+        if isinstance(time, slice):
+            start, end, time = time.start, time.stop, None
+        return self.get('select', sites=sites, sources=sources,
+                        read_vars=read_vars, time=time, start=start,
+                        end=end, category=category)
+
+    def aggregate(self, site, source, level):
+        """Aggregate at level with (variable, statistic) columns"""
+        return self.get('aggregate', site=site, source=source, level=level)
+
+    def stats(self, site, source, read_vars=None, obs='flux', level=None):
+        """Stats indexed by variable with a column for each metric"""
+        return self.get('stats', site=site, source=source,
+                        read_vars=read_vars, obs=obs, level=level)
+
+    def get(self, endpoint, **kwargs):
+        """Query endpoint with the arguments in kwargs (None is omitted and
+           lists are joined with commas) and decode the response"""
+        args = []
+        for key, value in sorted(kwargs.items()):
+            if value is None:
+                continue
+            if not isinstance(value, str) and hasattr(value, '__iter__'):
+                value = ','.join([str(x) for x in value])
+            args.append((key, str(value)))
+        path = '/{}?{}'.format(endpoint, urllib.parse.urlencode(args))
+        connection = self._connect()
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            body = response.read()
+        finally:
+            connection.close()
+        if response.status == 404:
+            raise KeyError(body.decode('utf-8'))
+        if response.status != 200:
+            raise ValueError(body.decode('utf-8'))
+        return decodeFrame(body)
+
+    def _connect(self):
+        if ':' in self.address:
+            host, port = self.address.rsplit(':', 1)
+            return http.client.HTTPConnection(host, int(port),
+                                              timeout=self.timeout)
+        return _UnixHTTPConnection(self.address, timeout=self.timeout)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection over a Unix socket"""
+
+    def __init__(self, path, timeout=None):
+        http.client.HTTPConnection.__init__(self, 'localhost',
+                                            timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def serve(analysis, address, cachesize=256, cachebytes=2**28):
+    """Serve analysis on address ('host:port' or the path of a Unix socket)
+       until interrupted. At most cachesize responses and cachebytes bytes
+       are cached"""
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        server = PlumberServer((host, int(port)), analysis, cachesize,
+                               cachebytes)
+    else:
+        server = UnixPlumberServer(address, analysis, cachesize, cachebytes)
+    logging.info('Serving %s', address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return server
+
+
+def query(p, endpoint, args):
+    """Run a query against PlumberAnalysis p and return the encoded frame.
+       Raises KeyError for data that are not available and ValueError for
+       unknown endpoints or arguments"""
+    args = dict(args)
+    if endpoint == 'keys':
+        keys = p.selectKeys()
+        index = pd.MultiIndex.from_tuples(keys, names=['site', 'source',
+                                                       'variable']) \
+            if keys else pd.Index([])
+        return encodeFrame(pd.DataFrame(index=index))
+    if endpoint == 'select':
+        time = args.pop('time', None)
+        start = args.pop('start', None)
+        end = args.pop('end', None)
+        if start is not None or end is not None:
+            if time is not None:
+                raise ValueError('time cannot be combined with start and end')
+            time = slice(start, end)
+        df = p.select(_list(args.pop('sites', None)),
+                      _list(args.pop('sources', None)),
+                      _list(args.pop('read_vars', None)), time,
+                      args.pop('category', None), stack=True)
+    elif endpoint == 'aggregate':
+        site, source, level = _required(args, 'site', 'source', 'level')
+        df = p.aggregates[site][source][level]
+    elif endpoint == 'stats':
+        site, source = _required(args, 'site', 'source')
+        obs = args.pop('obs', 'flux')
+        level = args.pop('level', None)
+        if level is not None:
+            # calcAtomStats would build missing aggregates in p
+            for x in (source, obs):
+                if level not in p.aggregates.get(site, {}).get(x, {}):
+                    raise KeyError('no stored {} aggregate for {} {}'.
+                                   format(level, site, x))
+        stats = p.calcAtomStats(site, source, _list(args.pop('read_vars',
+                                                             None)),
+                                obs, level)
+        if stats is None:
+            raise KeyError('no paired data for {} {}'.format(site, source))
+        df = pd.DataFrame(stats)
+    else:
+        raise ValueError('unknown endpoint {}'.format(endpoint))
+    if args:
+        raise ValueError('unknown arguments {}'.format(', '.join(args)))
+    return encodeFrame(df)
+
+
+def encodeFrame(df):
+    """Encode a dataframe with numeric values as a 4-byte header length, a
+       JSON header with the column labels and the index type and labels,
+       and the index (unless it is in the header) and values as numpy
+       arrays"""
+    header = {'columns': [list(x) if isinstance(x, tuple) else x
+                          for x in df.columns],
+              'column_names': list(df.columns.names),
+              'index_names': list(df.index.names)}
+    index = None
+    if isinstance(df.index, pd.DatetimeIndex):
+        header['index'] = 'datetime'
+        index = np.asarray(df.index.values).astype('datetime64[ns]').\
+            view(np.int64)
+    elif isinstance(df.index, pd.MultiIndex) or \
+            df.index.dtype.kind not in 'iuf':
+        header['index'] = [list(x) if isinstance(x, tuple) else x
+                           for x in df.index]
+    else:
+        header['index'] = 'numeric'
+        index = np.asarray(df.index.values)
+    header = json.dumps(header, default=str).encode('utf-8')
+    buffer = BytesIO()
+    buffer.write(struct.pack('>I', len(header)))
+    buffer.write(header)
+    if index is not None:
+        np.save(buffer, index, allow_pickle=False)
+    np.save(buffer, np.asarray(df.values, dtype=float), allow_pickle=False)
+    return buffer.getvalue()
+
+
+def decodeFrame(data):
+    """Decode a dataframe that was encoded with encodeFrame"""
+    buffer = BytesIO(data)
+    size = struct.unpack('>I', buffer.read(4))[0]
+    header = json.loads(buffer.read(size).decode('utf-8'))
+    if header['index'] == 'datetime':
+        index = pd.DatetimeIndex(np.load(buffer).view('datetime64[ns]'))
+    elif header['index'] == 'numeric':
+        index = pd.Index(np.load(buffer))
+    else:
+        index = _labels(header['index'])
+    index.names = header['index_names']
+    columns = _labels(header['columns'])
+    columns.names = header['column_names']
+    values = np.load(buffer)
+    return pd.DataFrame(values, index=index, columns=columns)
+
+
+def _labels(labels):
+    """Index (or MultiIndex if the labels are lists) from JSON labels"""
+    if labels and isinstance(labels[0], list):
+        return pd.MultiIndex.from_tuples([tuple(x) for x in labels])
+    return pd.Index(labels)
+
+
+def _list(value):
+    """Split a comma-separated argument"""
+    if value is None:
+        return None
+    return value.split(',')
+
+
+def _required(args, *keys):
+    """Pop the required arguments keys from args"""
+    missing = [x for x in keys if x not in args]
+    if missing:
+        raise ValueError('missing arguments {}'.format(', '.join(missing)))
+    return [args.pop(x) for x in keys]
+
+
+def _removeStaleSocket(path):
+    """Remove the socket file path if it is left over from a server that
+       has stopped. Raises OSError if a server is still listening on it"""
+    if not os.path.exists(path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except ConnectionRefusedError:
+        logging.info('Removing stale socket %s', path)
+        os.remove(path)
+        return
+    except OSError:
+        # not a socket, leave it to bind to report
+        return
+    finally:
+        sock.close()
+    raise OSError(errno.EADDRINUSE, 'A server is already listening on {}'.
+                  format(path))
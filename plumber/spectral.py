@@ -0,0 +1,225 @@
+"""
+Spectral analysis for plumber
+
+Power spectra, coherence and lagged cross-correlation of half-hourly model
+output against observations. All sources for a site are transformed in a
+single batched real FFT. Gaps are handled by filling them with zeros after
+removing the mean of the valid data and by transforming the validity masks
+along with the data, so that the lagged correlation at each lag is based
+on the number of valid pairs at that lag. The series are zero-padded to at
+least twice their length, which turns the circular correlation of the FFT
+into a linear one.
+"""
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+# number of time steps per day
+steps_per_day = 48
+
+
+def nextFastLength(n):
+    """Smallest integer >= n that has no prime factors other than 2, 3 and
+       5, which is an efficient FFT length"""
+    best = 2 * n
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            p = p35
+            while p < n:
+                p *= 2
+            best = min(best, p)
+            p35 *= 3
+        p5 *= 5
+    return max(best, 1)
+
+
+def spectralAnalysis(df, reference, maxlag=3*steps_per_day, nbands=50):
+    """Power spectra of all sources and coherence, phase and lagged
+       cross-correlation of each source against a reference
+
+    Parameters
+    ----------
+    Required:
+        df : pandas dataframe
+            half-hourly time series of a single variable with one column per
+            source on a common regular index. NaN marks missing data
+        reference : string
+            column in df to compare against (usually the observations)
+    Default:
+        maxlag : int
+            maximum lag (in time steps) of the cross-correlation
+            (default=3 days)
+        nbands : int
+            number of logarithmically spaced frequency bands over which the
+            spectra are averaged (default=50)
+
+    Returns
+    -------
+    result : OrderedDict
+        'power' : power spectral density (units**2 per cycle per day) by
+            frequency band (cycles per day) for each column in df
+        'coherence' : squared coherence of each source with reference by
+            frequency band. NaN for bands that contain a single frequency,
+            for which coherence is not defined
+        'phase' : phase of each source relative to reference (radians) by
+            frequency band. A positive phase means that the source lags the
+            reference
+        'correlation' : correlation of source(t+lag) with reference(t) for
+            lags (in hours) from -maxlag to maxlag
+        'count' : number of valid pairs for each lag
+    """
+    sources = [x for x in df.columns if x != reference]
+    columns = [reference] + sources
+    values = np.asarray(df[columns].values, dtype=float).T
+    mask = ~np.isnan(values)
+    nvalid = mask.sum(axis=1)
+    means = np.where(nvalid > 0,
+                     np.nansum(values, axis=1) / np.maximum(nvalid, 1), 0)
+    filled = np.where(mask, values - means[:, None], 0)
+
+    # one FFT for the data and the masks of all sources
+    nsteps = values.shape[1]
+    nfft = nextFastLength(2 * nsteps)
+    spectra = np.fft.rfft(np.vstack([filled, mask]), n=nfft, axis=1)
+    fdata = spectra[:len(columns)]
+    fmask = spectra[len(columns):]
+
+    result = OrderedDict()
+    frequency = np.fft.rfftfreq(nfft, 1/steps_per_day)
+    power = (fdata * fdata.conj()).real
+    cross = fdata[1:] * fdata[0].conj()
+    starts, centres = _bands(frequency, nbands)
+    band_power = _bandMean(power, starts)
+    band_cross = _bandMean(cross, starts)
+    nbins = np.diff(np.append(starts, len(frequency)))
+
+    # one-sided spectral density normalized so that it integrates to the
+    # variance of the valid data
+    density = 2 * band_power / (nfft * np.maximum(nvalid, 1)[:, None]) / \
+        (steps_per_day / nfft)
+    result['power'] = _frame(density.T, centres, columns, 'frequency')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        coherence = abs(band_cross)**2 / (band_power[1:] * band_power[0])
+    coherence[:, nbins < 2] = np.nan
+    result['coherence'] = _frame(coherence.T, centres, sources, 'frequency')
+    result['phase'] = _frame(-np.angle(band_cross).T, centres, sources,
+                             'frequency')
+
+    # lagged cross-correlation, normalized by the number of valid pairs
+    lagged = np.fft.irfft(cross, n=nfft, axis=1)
+    pairs = np.fft.irfft(fmask[1:] * fmask[0].conj(), n=nfft, axis=1)
+    lags = np.arange(-maxlag, maxlag+1)
+    lagged = lagged[:, lags % nfft]
+    pairs = np.round(pairs[:, lags % nfft]).astype(np.int64)
+    variance = (filled**2).sum(axis=1) / np.maximum(nvalid, 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        correlation = lagged / np.where(pairs > 0, pairs, np.nan) / \
+            np.sqrt(variance[1:, None] * variance[0])
+    hours = lags * 24. / steps_per_day
+    result['correlation'] = _frame(correlation.T, hours, sources, 'lag')
+    result['count'] = _frame(pairs.T, hours, sources, 'lag')
+    return result
+
+
+def diurnalComposite(df):
+    """Mean diurnal cycle of each column in df on steps_per_day slots,
+       ignoring NaN"""
+    minutes = np.asarray(df.index.hour) * 60 + np.asarray(df.index.minute)
+    slots = minutes * steps_per_day // (24*60)
+    values = np.asarray(df.values, dtype=float)
+    valid = ~np.isnan(values)
+    ncols = values.shape[1]
+    codes = slots[:, None] * ncols + np.arange(ncols)
+    size = steps_per_day * ncols
+    sums = np.bincount(codes[valid], values[valid], size)
+    counts = np.bincount(codes[valid], minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        composite = (sums / counts).reshape(steps_per_day, ncols)
+    hours = np.arange(steps_per_day) * 24. / steps_per_day
+    return _frame(composite, hours, df.columns, 'hour')
+
+
+def diurnalCorrelation(x, y):
+    """Circular cross-correlation of diurnal cycles, calculated for all
+       cycles at once with a single FFT
+
+    Parameters
+    ----------
+    Required:
+        x, y : numpy arrays
+            diurnal cycles with the slots along the last axis. The other
+            dimensions must be the same or broadcastable
+
+    Returns
+    -------
+    correlation : numpy array
+        correlation of x(t+lag) with y(t) for lag = 0 ... nslots-1 (in time
+        steps) along the last axis. NaN where either cycle is constant or
+        incomplete
+    """
+    nslots = x.shape[-1]
+    x = x - x.mean(axis=-1, keepdims=True)
+    y = y - y.mean(axis=-1, keepdims=True)
+    cross = np.fft.irfft(np.fft.rfft(x, axis=-1) *
+                         np.fft.rfft(y, axis=-1).conj(), n=nslots, axis=-1)
+    norm = np.sqrt((x**2).sum(axis=-1) * (y**2).sum(axis=-1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return cross / norm[..., None]
+
+
+def peakLag(correlation):
+    """Lag (in time steps) of the maximum of circular correlation curves
+       (see diurnalCorrelation), refined to a fraction of a time step by
+       fitting a parabola through the maximum and its two neighbours.
+       Returns the lags in (-nslots/2, nslots/2] and the maximum
+       correlation. Both are NaN for curves that contain NaN"""
+    correlation = np.asarray(correlation)
+    shape = correlation.shape[:-1]
+    nslots = correlation.shape[-1]
+    curves = correlation.reshape(-1, nslots)
+    rows = np.arange(len(curves))
+    bad = np.isnan(curves).any(axis=-1)
+    filled = np.where(np.isnan(curves), -np.inf, curves)
+    k = np.argmax(filled, axis=-1)
+    y0 = filled[rows, k]
+    y1 = filled[rows, (k-1) % nslots]
+    y2 = filled[rows, (k+1) % nslots]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        curvature = y1 - 2*y0 + y2
+        delta = np.where(curvature < 0, 0.5 * (y1 - y2) / curvature, 0)
+    lag = (k + delta + nslots/2.) % nslots - nslots/2.
+    lag = np.where(lag == -nslots/2., nslots/2., lag)
+    lag[bad] = np.nan
+    peak = np.where(bad, np.nan, y0)
+    lag = lag.reshape(shape)
+    peak = peak.reshape(shape)
+    return lag, peak
+
+
+def _bands(frequency, nbands):
+    """Start positions and (geometric) centre frequencies of logarithmically
+       spaced bands that cover the non-zero frequencies. Empty bands are
+       dropped"""
+    edges = np.logspace(np.log10(frequency[1]), np.log10(frequency[-1]),
+                        nbands+1)
+    edges[-1] = np.inf
+    starts = np.unique(np.searchsorted(frequency, edges[:-1]))
+    starts = starts[starts < len(frequency)]
+    ends = np.append(starts[1:], len(frequency))
+    centres = np.sqrt(frequency[starts] * frequency[ends-1])
+    return starts, centres
+
+
+def _bandMean(x, starts):
+    """Mean of x (along the last axis) over the bands that begin at
+       starts"""
+    counts = np.diff(np.append(starts, x.shape[-1]))
+    return np.add.reduceat(x, starts, axis=-1) / counts
+
+
+def _frame(values, index, columns, name):
+    """Dataframe with a named index"""
+    return pd.DataFrame(values, index=pd.Index(index, name=name),
+                        columns=columns)
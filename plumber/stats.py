@@ -83,5 +83,495 @@ def histOverlap(df1, df2, nbins=25):
         bins = np.linspace(lower[var], upper[var], nbins+1)
         hdf1 = np.histogram(df1[var], bins=bins)
         hdf2 = np.histogram(df2[var], bins=bins)
-        overlap[var] = np.minimum(hdf1[0], hdf2[0]).sum()/len(df1[var])
+        overlap[var] = np.minimum(hdf1[0], hdf2[0]).sum()/df1[var].count()
     return overlap
+
+
+def calcAllStatsChunked(data1, data2, chunksize=48*365, nbins=25,
+                        variables=None, pairwise=False):
+    """Calculate all the stats in calcAllStats chunk by chunk, so that
+       neither data1 nor data2 needs to be in memory at once. data1 and data2
+       can be pandas DataFrames or plumber.io.ChunkedTimeSeries. The results
+       are the same as those from calcAllStats (for the variables that are
+       common to data1 and data2), but require three passes over the data:
+       one for the moments, one for the histograms and the normalized mean
+       error and one to resolve the percentiles exactly. If pairwise is True,
+       only time steps at which both data1 and data2 are valid are used"""
+    common = set(data1.columns).intersection(data2.columns)
+    if variables is not None:
+        common = common.intersection(variables)
+    variables = sorted(common)
+    start = min(data1.index[0], data2.index[0])
+    end = max(data1.index[-1], data2.index[-1])
+
+    def chunkPairs():
+        for c1, c2 in zip(_iterChunks(data1, start, end, chunksize,
+                                      variables),
+                          _iterChunks(data2, start, end, chunksize,
+                                      variables)):
+            x = c1[variables].values.astype(float)
+            y = c2[variables].values.astype(float)
+            if pairwise:
+                invalid = np.isnan(x) | np.isnan(y)
+                x[invalid] = np.nan
+                y[invalid] = np.nan
+            yield x, y
+
+    # first pass: moments, range and pairwise sums
+    m1 = _Moments(variables)
+    m2 = _Moments(variables)
+    pairs = _PairSums(variables)
+    for x, y in chunkPairs():
+        m1.update(x)
+        m2.update(y)
+        pairs.update(x, y)
+
+    # second pass: histograms for the overlap and the percentiles and the
+    # denominator of the normalized mean error
+    percentiles = [0.05, 0.95]
+    lower = np.minimum(m1.min, m2.min)
+    upper = np.maximum(m1.max, m2.max)
+    hist1 = _Histograms(lower, upper, nbins)
+    hist2 = _Histograms(lower, upper, nbins)
+    q1 = _Quantiles(m1, percentiles)
+    q2 = _Quantiles(m2, percentiles)
+    nme_denominator = np.zeros(len(variables))
+    for x, y in chunkPairs():
+        hist1.update(x)
+        hist2.update(y)
+        q1.update(x)
+        q2.update(y)
+        nme_denominator += np.nansum(abs(m2.mean() - y), axis=0)
+
+    # third pass: only needed to collect the values in the histogram bins
+    # that contain the requested percentiles
+    need1 = q1.needsValues()
+    need2 = q2.needsValues()
+    if need1 or need2:
+        for x, y in chunkPairs():
+            q1.collect(x)
+            q2.collect(y)
+
+    def series(values):
+        return pd.Series(values, index=variables)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        overlap = np.minimum(hist1.counts, hist2.counts).sum(axis=1) / m1.n
+        nme = pairs.absdiff / nme_denominator
+    overlap[np.isnan(lower) | np.isnan(upper)] = np.nan
+    stats = {}
+    stats['Absolute bias'] = series(abs(m1.mean() - m2.mean()))
+    stats['1 - stdev ratio'] = series(abs(1 - m1.std()/m2.std()))
+    stats['1 - Correlation'] = series(1 - pairs.corr())
+    stats['Normalized mean absolute error'] = series(nme)
+    stats['Difference in 5th percentile'] = \
+        series(abs(q1.quantile(0.05) - q2.quantile(0.05)))
+    stats['Difference in 95th percentile'] = \
+        series(abs(q1.quantile(0.95) - q2.quantile(0.95)))
+    stats['1 - skewness ratio'] = series(abs(1 - m1.skew() / m2.skew()))
+    stats['1 - kurtosis ratio'] = series(abs(1 - m1.kurt() / m2.kurt()))
+    stats['1 - overlap statistic'] = series(1 - overlap)
+    return stats
+
+
+def groupCodes(index, by, met=None, nquantiles=4, threshold=5.):
+    """Calculate integer group codes for each time step in index
+
+    Parameters
+    ----------
+    Required:
+        index : pandas DatetimeIndex
+            time steps to classify
+        by : string
+            'month', 'season' (DJF, MAM, JJA, SON), 'hour' (hour of day),
+            'daytime' (day or night based on SWdown in met) or 'swdown'
+            (night and quantiles of daytime SWdown in met)
+    Default:
+        met : pandas dataframe
+            meteorological forcing with SWdown, required for 'daytime' and
+            'swdown' (default=None)
+        nquantiles : int
+            number of daytime SWdown quantiles for 'swdown' (default=4)
+        threshold : float
+            SWdown (W/m2) above which it is day for 'daytime' (default=5)
+
+    Returns
+    -------
+    codes : numpy array
+        group code (0 <= code < len(labels)) for each time step in index or
+        -1 if the time step cannot be classified
+    labels : list
+        label for each group
+    """
+    if by == 'month':
+        return np.asarray(index.month) - 1, list(range(1, 13))
+    if by == 'season':
+        return (np.asarray(index.month) % 12) // 3, ['DJF', 'MAM', 'JJA',
+                                                     'SON']
+    if by == 'hour':
+        return np.asarray(index.hour), list(range(24))
+    if by not in ('daytime', 'swdown'):
+        raise ValueError('Unknown grouping: {}'.format(by))
+    if met is None or 'SWdown' not in met:
+        raise ValueError('Grouping by {} requires SWdown'.format(by))
+    swdown = np.asarray(met['SWdown'].reindex(index).values, dtype=float)
+    valid = ~np.isnan(swdown)
+    codes = np.full(len(index), -1, dtype=np.int64)
+    if by == 'daytime':
+        codes[valid] = (swdown[valid] > threshold).astype(np.int64)
+        return codes, ['night', 'day']
+    # quantiles of the daytime values, so that the many zeros at night do not
+    # collapse the lower quantiles. Night is a separate group
+    day = valid & (swdown > threshold)
+    codes[valid & ~day] = 0
+    if day.any():
+        edges = np.percentile(swdown[day],
+                              np.linspace(0, 100, nquantiles+1)[1:-1])
+        codes[day] = np.searchsorted(edges, swdown[day], side='right') + 1
+    return codes, ['night'] + ['Q{}'.format(x+1) for x in range(nquantiles)]
+
+
+def calcGroupedStats(df1, df2, codes, labels, nbins=25):
+    """Calculate all the stats in calcAllStats for each group in a single
+       grouped pass. Only time steps at which df1 and df2 are both valid are
+       used.
+
+    Parameters
+    ----------
+    Required:
+        df1, df2 : pandas dataframes
+            aligned time series with the same columns
+        codes : numpy array
+            group code for each time step (see groupCodes). Time steps with
+            negative codes are excluded
+        labels : list
+            label for each group
+
+    Returns
+    -------
+    stats : pandas dataframe
+        table with group, variable, metric and value columns
+    """
+    ngroups = len(labels)
+    codes = np.asarray(codes)
+    rows = []
+    for var in df1.columns:
+        x = np.asarray(df1[var].values, dtype=float)
+        y = np.asarray(df2[var].values, dtype=float)
+        valid = ~(np.isnan(x) | np.isnan(y)) & (codes >= 0)
+        stats = _groupedStats(x[valid], y[valid], codes[valid], ngroups,
+                              nbins)
+        for metric in sorted(stats):
+            for label, value in zip(labels, stats[metric]):
+                rows.append((label, var, metric, value))
+    return pd.DataFrame(rows, columns=['group', 'variable', 'metric',
+                                       'value'])
+
+
+def _groupedStats(x, y, g, ngroups, nbins):
+    """Grouped version of calcAllStats for 1D arrays x and y with group codes
+       g. Returns a dictionary of arrays with one value per group"""
+    n = np.bincount(g, minlength=ngroups).astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mx, sdx, skx, kux = _groupedMoments(x, g, n, ngroups)
+        my, sdy, sky, kuy = _groupedMoments(y, g, n, ngroups)
+        dx = x - mx[g]
+        dy = y - my[g]
+        corr = np.bincount(g, dx*dy, ngroups) / \
+            np.sqrt(np.bincount(g, dx*dx, ngroups) *
+                    np.bincount(g, dy*dy, ngroups))
+        nme = np.bincount(g, abs(x - y), ngroups) / \
+            np.bincount(g, abs(dy), ngroups)
+
+        # sort each group once for the percentiles
+        xs = x[np.lexsort((x, g))]
+        ys = y[np.lexsort((y, g))]
+        starts = np.concatenate([[0], np.cumsum(n)[:-1]]).astype(np.int64)
+
+        # histograms on common bins for each group
+        lower = np.fmin(_groupedExtreme(np.minimum, x, g, ngroups),
+                        _groupedExtreme(np.minimum, y, g, ngroups))
+        upper = np.fmax(_groupedExtreme(np.maximum, x, g, ngroups),
+                        _groupedExtreme(np.maximum, y, g, ngroups))
+        width = (upper - lower) / nbins
+        h1 = _groupedHistogram(x, g, lower, width, ngroups, nbins)
+        h2 = _groupedHistogram(y, g, lower, width, ngroups, nbins)
+        overlap = np.minimum(h1, h2).sum(axis=1) / n
+
+        stats = {}
+        stats['Absolute bias'] = abs(mx - my)
+        stats['1 - stdev ratio'] = abs(1 - sdx/sdy)
+        stats['1 - Correlation'] = 1 - corr
+        stats['Normalized mean absolute error'] = nme
+        stats['Difference in 5th percentile'] = \
+            abs(_groupedQuantile(xs, starts, n, 0.05) -
+                _groupedQuantile(ys, starts, n, 0.05))
+        stats['Difference in 95th percentile'] = \
+            abs(_groupedQuantile(xs, starts, n, 0.95) -
+                _groupedQuantile(ys, starts, n, 0.95))
+        stats['1 - skewness ratio'] = abs(1 - skx/sky)
+        stats['1 - kurtosis ratio'] = abs(1 - kux/kuy)
+        stats['1 - overlap statistic'] = 1 - overlap
+    return stats
+
+
+def _groupedMoments(x, g, n, ngroups):
+    """Mean, standard deviation, skewness and kurtosis by group, using the
+       pandas (bias-corrected) definitions"""
+    mean = np.bincount(g, x, ngroups) / n
+    d = x - mean[g]
+    m2 = np.bincount(g, d**2, ngroups)
+    m3 = np.bincount(g, d**3, ngroups)
+    m4 = np.bincount(g, d**4, ngroups)
+    std = np.where(n > 1, np.sqrt(m2 / (n-1)), np.nan)
+    skew = np.where(n > 2, n * np.sqrt(n-1) / (n-2) * m3 / m2**1.5, np.nan)
+    kurt = np.where(n > 3, n*(n+1)*(n-1) * m4 / ((n-2)*(n-3) * m2**2) -
+                    3*(n-1)**2 / ((n-2)*(n-3)), np.nan)
+    return mean, std, skew, kurt
+
+
+def _groupedExtreme(ufunc, x, g, ngroups):
+    """Minimum (ufunc=np.minimum) or maximum (ufunc=np.maximum) by group"""
+    fill = np.inf if ufunc is np.minimum else -np.inf
+    result = np.full(ngroups, fill)
+    ufunc.at(result, g, x)
+    result[np.isinf(result)] = np.nan
+    return result
+
+
+def _groupedHistogram(x, g, lower, width, ngroups, nbins):
+    """Histogram with nbins equal bins from lower to lower+nbins*width for
+       each group. As in np.histogram, the last bin includes its upper
+       edge"""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        b = np.floor((x - lower[g]) / width[g])
+    b = np.clip(np.nan_to_num(b), 0, nbins-1).astype(np.int64)
+    return np.bincount(g*nbins + b, minlength=ngroups*nbins).\
+        reshape(ngroups, nbins)
+
+
+def _groupedQuantile(sorted_values, starts, n, q):
+    """Quantile with linear interpolation (as in pandas) by group, given the
+       values sorted within each group and the start and size of each
+       group"""
+    result = np.full(len(n), np.nan)
+    has = n > 0
+    h = (n[has] - 1) * q
+    lo = np.floor(h).astype(np.int64)
+    hi = np.ceil(h).astype(np.int64)
+    vlo = sorted_values[starts[has] + lo]
+    vhi = sorted_values[starts[has] + hi]
+    result[has] = vlo + (h - lo) * (vhi - vlo)
+    return result
+
+
+def _iterChunks(data, start=None, end=None, chunksize=48*365,
+                read_vars=None):
+    """Iterate over a DataFrame or a ChunkedTimeSeries (anything with an
+       iterChunks method) in chunks. For a DataFrame the chunks are slices
+       (views) of the original data"""
+    if hasattr(data, 'iterChunks'):
+        for chunk in data.iterChunks(start, end, read_vars):
+            yield chunk
+        return
+    if read_vars is not None:
+        data = data[[x for x in read_vars if x in data.columns]]
+    if start is not None or end is not None:
+        if start is None:
+            start = data.index[0]
+        if end is None:
+            end = data.index[-1]
+        data = data.reindex(pd.date_range(start, end, freq='30Min'))
+    for i in range(0, len(data), chunksize):
+        yield data.iloc[i:i+chunksize]
+
+
+class _Moments(object):
+    """Running power sums, minimum and maximum for each column. The sums are
+       calculated relative to the mean of the first chunk to limit the loss
+       of precision. The moments follow the pandas (bias-corrected)
+       definitions"""
+
+    def __init__(self, variables):
+        nvars = len(variables)
+        self.shift = None
+        self.n = np.zeros(nvars)
+        self.sums = np.zeros((4, nvars))
+        self.min = np.full(nvars, np.nan)
+        self.max = np.full(nvars, np.nan)
+
+    def update(self, x):
+        valid = ~np.isnan(x)
+        if self.shift is None:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                self.shift = np.nan_to_num(np.nansum(x, axis=0) /
+                                           valid.sum(axis=0))
+        d = np.where(valid, x - self.shift, 0)
+        self.n += valid.sum(axis=0)
+        for i in range(4):
+            self.sums[i] += (d**(i+1)).sum(axis=0)
+        if valid.any():
+            with np.errstate(invalid='ignore'):
+                self.min = np.fmin(self.min, np.nanmin(np.where(valid, x,
+                                                                np.inf),
+                                                       axis=0))
+                self.max = np.fmax(self.max, np.nanmax(np.where(valid, x,
+                                                                -np.inf),
+                                                       axis=0))
+            self.min[np.isinf(self.min)] = np.nan
+            self.max[np.isinf(self.max)] = np.nan
+
+    def _central(self):
+        """Return n and the central sums of the 2nd, 3rd and 4th power"""
+        n = self.n
+        with np.errstate(invalid='ignore', divide='ignore'):
+            d = self.sums[0] / n
+        s2, s3, s4 = self.sums[1:]
+        m2 = s2 - n*d**2
+        m3 = s3 - 3*d*s2 + 2*n*d**3
+        m4 = s4 - 4*d*s3 + 6*d**2*s2 - 3*n*d**4
+        return n, m2, m3, m4
+
+    def mean(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.shift + self.sums[0] / self.n
+
+    def std(self):
+        n, m2, m3, m4 = self._central()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(n > 1, np.sqrt(m2 / (n-1)), np.nan)
+
+    def skew(self):
+        n, m2, m3, m4 = self._central()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            skew = n * np.sqrt(n-1) / (n-2) * m3 / m2**1.5
+        return np.where(n > 2, skew, np.nan)
+
+    def kurt(self):
+        n, m2, m3, m4 = self._central()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            kurt = (n*(n+1)*(n-1) * m4 / ((n-2)*(n-3) * m2**2) -
+                    3*(n-1)**2 / ((n-2)*(n-3)))
+        return np.where(n > 3, kurt, np.nan)
+
+
+class _PairSums(object):
+    """Running sums over pairwise valid samples for the correlation and the
+       numerator of the normalized mean error"""
+
+    def __init__(self, variables):
+        nvars = len(variables)
+        self.n = np.zeros(nvars)
+        self.sums = np.zeros((5, nvars))
+        self.absdiff = np.zeros(nvars)
+        self.shift = None
+
+    def update(self, x, y):
+        valid = ~(np.isnan(x) | np.isnan(y))
+        if self.shift is None:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                self.shift = (
+                    np.nan_to_num(np.where(valid, x, 0).sum(axis=0) /
+                                  valid.sum(axis=0)),
+                    np.nan_to_num(np.where(valid, y, 0).sum(axis=0) /
+                                  valid.sum(axis=0)))
+        dx = np.where(valid, x - self.shift[0], 0)
+        dy = np.where(valid, y - self.shift[1], 0)
+        self.n += valid.sum(axis=0)
+        for i, v in enumerate([dx, dy, dx*dx, dy*dy, dx*dy]):
+            self.sums[i] += v.sum(axis=0)
+        self.absdiff += np.nansum(abs(x - y), axis=0)
+
+    def corr(self):
+        n = self.n
+        sx, sy, sxx, syy, sxy = self.sums
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cov = sxy - sx*sy/n
+            return cov / np.sqrt((sxx - sx**2/n) * (syy - sy**2/n))
+
+
+class _Histograms(object):
+    """Running histograms with nbins bins between lower and upper for each
+       column"""
+
+    def __init__(self, lower, upper, nbins):
+        self.lower = lower
+        self.upper = upper
+        self.nbins = nbins
+        self.counts = np.zeros((len(lower), nbins), dtype=np.int64)
+
+    def update(self, x):
+        for i in range(len(self.lower)):
+            if np.isnan(self.lower[i]) or np.isnan(self.upper[i]):
+                continue
+            values = x[:, i]
+            values = values[~np.isnan(values)]
+            # to get nbins bins, you need one more boundary
+            bins = np.linspace(self.lower[i], self.upper[i], self.nbins+1)
+            self.counts[i] += np.histogram(values, bins=bins)[0]
+
+
+class _Quantiles(object):
+    """Exact quantiles (with linear interpolation as in pandas) from two or
+       three passes over the data. The first pass through the data is done by
+       _Moments. The second pass builds a fine histogram, which identifies the
+       bins that contain the order statistics that are needed. The third
+       pass collects the values in those bins only"""
+
+    def __init__(self, moments, percentiles, nbins=4096):
+        self.n = moments.n.astype(np.int64)
+        self.lower = moments.min
+        self.upper = moments.max
+        self.percentiles = percentiles
+        self.hist = _Histograms(self.lower, self.upper, nbins)
+        self.values = None
+        self.ranks = None
+
+    def update(self, x):
+        self.hist.update(x)
+
+    def needsValues(self):
+        """Determine which bins are needed. Returns False if there are no
+           valid values at all"""
+        self.ranks = {}
+        for i in range(len(self.n)):
+            if self.n[i] == 0:
+                continue
+            cumulative = np.cumsum(self.hist.counts[i])
+            for q in self.percentiles:
+                h = (self.n[i] - 1) * q
+                for rank in sorted(set([int(np.floor(h)), int(np.ceil(h))])):
+                    b = np.searchsorted(cumulative, rank, side='right')
+                    before = cumulative[b-1] if b > 0 else 0
+                    self.ranks[(i, rank)] = (b, rank - before)
+        self.values = dict([(key, []) for key in self.ranks])
+        return bool(self.ranks)
+
+    def collect(self, x):
+        for (i, rank), (b, offset) in self.ranks.items():
+            values = x[:, i]
+            values = values[~np.isnan(values)]
+            bins = np.linspace(self.lower[i], self.upper[i],
+                               self.hist.nbins+1)
+            # np.histogram puts the upper boundary in the last bin
+            idx = np.clip(np.searchsorted(bins, values, side='right') - 1,
+                          0, self.hist.nbins-1)
+            self.values[(i, rank)].append(values[idx == b])
+
+    def quantile(self, q):
+        result = np.full(len(self.n), np.nan)
+        for i in range(len(self.n)):
+            if self.n[i] == 0:
+                continue
+            h = (self.n[i] - 1) * q
+            lo = int(np.floor(h))
+            hi = int(np.ceil(h))
+            vlo = self._orderStatistic(i, lo)
+            vhi = self._orderStatistic(i, hi)
+            result[i] = vlo + (h - lo) * (vhi - vlo)
+        return result
+
+    def _orderStatistic(self, i, rank):
+        b, offset = self.ranks[(i, rank)]
+        values = np.sort(np.concatenate(self.values[(i, rank)]))
+        return values[offset]
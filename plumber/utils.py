@@ -1,6 +1,11 @@
 """
 Utility functions for plumber
 """
+import os
+import resource
+import shutil
+import sys
+import zlib
 import numpy as np
 
 
@@ -22,6 +27,17 @@ def cast(x):
     return x
 
 
+def copy(src, dst):
+    """Copy src to dst. A hard link is used if possible, which avoids copying
+       large files on a shared filesystem"""
+    try:
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
 def flatten(*args):
     """flatten a list of lists"""
     for x in args:
@@ -48,6 +64,38 @@ def lv(T, units='K'):
     return L
 
 
+def peakMemory():
+    """Return the peak resident set size of the current process in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on OS X and in kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return peak / 1024**2
+    return peak / 1024
+
+
+def parseShard(x):
+    """Parse a shard specification of the form 'i/N' into (i, N), where
+       0 <= i < N"""
+    try:
+        shard, nshards = [int(y) for y in x.split('/')]
+    except (AttributeError, ValueError):
+        raise ValueError('Shard should be specified as i/N: {}'.format(x))
+    if nshards < 1 or not 0 <= shard < nshards:
+        raise ValueError('Shard should satisfy 0 <= i < N: {}'.format(x))
+    return (shard, nshards)
+
+
+def shardOf(key, keys, nshards):
+    """Assign key to one of nshards round-robin based on its position in
+       keys. Keys that are not in keys are assigned based on a checksum of
+       their string representation, so that the result is the same for every
+       process"""
+    try:
+        return keys.index(key) % nshards
+    except ValueError:
+        return zlib.crc32(str(key).encode('utf-8')) % nshards
+
+
 def toBool(x):
     """Convert a string to a boolean value. Just throw exception if it does not
        work."""
@@ -0,0 +1,99 @@
+"""Compare the time and file size per figure for Hovmoller plots of all sites
+   rendered one section at a time (plotHovmollerDoyVsHodMean, which creates a
+   new figure for each site) and rendered as a batch
+   (plotHovmollerDoyVsHodMeanBatch, which reuses a single figure). A third
+   variant uses the original groupby and pcolormesh rendering as a reference.
+   Synthetic half-hourly data are used, so no PLUMBER data are needed.
+
+   Usage: python benchmark_hovmoller.py [<nsites>] [<nyears>] [<outdir>]"""
+import os
+import sys
+import tempfile
+import time
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import plumber.plumber as pl
+from plumber import plot
+
+
+def synthetic(nyears, seed):
+    """Synthetic latent heat flux with a diurnal and a seasonal cycle"""
+    rng = np.random.RandomState(seed)
+    index = pd.date_range('2001-01-01', periods=nyears*365*48, freq='30Min')
+    hod = index.hour + index.minute/60
+    diurnal = np.clip(np.sin((hod - 6)/12*np.pi), 0, None)
+    seasonal = 1 + 0.5*np.sin((index.dayofyear - 80)/365*2*np.pi)
+    qle = 200*diurnal*seasonal + rng.normal(0, 20, len(index))
+    return pd.DataFrame({'Qle': qle}, index=index)
+
+
+def legacy(p, site, source, var, filename, info):
+    """The original rendering: groupby over lambdas and pcolormesh"""
+    df = p.data[site][source][var]
+    fig, axes = plt.subplots(1, 1, squeeze=False, figsize=info['figsize'])
+    grouped = df.groupby([lambda x: x.dayofyear,
+                          lambda x: x.hour + x.minute/60]).mean().unstack()
+    x = np.asarray(grouped.axes[1])
+    y = np.asarray(grouped.axes[0])
+    im = axes[0][0].pcolormesh(x, y, grouped.values, cmap=info['cmap'],
+                               vmin=np.nanmin(df.values),
+                               vmax=np.nanmax(df.values))
+    fig.colorbar(im, ax=[axes[0][0]], label=var)
+    fig.suptitle('{} @ {}: {}'.format(source, site, var))
+    fig.savefig(filename)
+    plt.close(fig)
+
+
+def report(label, timing):
+    seconds = np.mean([x[1] for x in timing])
+    size = np.mean([x[2] for x in timing])
+    print('{:<12s} {:8.3f} s/figure {:10.0f} bytes/figure'.format(label,
+                                                                 seconds,
+                                                                 size))
+
+
+nsites = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+nyears = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+outdir = sys.argv[3] if len(sys.argv) > 3 else tempfile.mkdtemp()
+
+p = pl.PlumberAnalysis()
+p.cfg = {'plot_defaults': {}, 'sites': {'sites': []},
+         'sources': {}, 'observations': {'observations': []}}
+sites = ['site{:02d}'.format(i) for i in range(nsites)]
+for i, site in enumerate(sites):
+    p.data[site] = {'model': synthetic(nyears, i)}
+p.buildAggregates(pyramid_levels=['annual'])
+info = {'read_vars': 'Qle', 'source': 'model', 'cmap': 'viridis',
+        'figsize': (6, 8)}
+
+timing = []
+for site in sites:
+    filename = os.path.join(outdir, 'legacy_{}.png'.format(site))
+    t0 = time.time()
+    legacy(p, site, 'model', 'Qle', filename, info)
+    timing.append((filename, time.time() - t0, os.path.getsize(filename)))
+report('legacy', timing)
+
+timing = []
+for site in sites:
+    section = 'plot_{}'.format(site)
+    filename = os.path.join(outdir, 'section_{}.png'.format(site))
+    p.cfg[section] = dict(info, site=site, plotfilename=filename,
+                          plot='plotHovmollerDoyVsHodMean')
+    t0 = time.time()
+    fig, axes = plot.plotHovmollerDoyVsHodMean(p, section)
+    plt.close(fig)
+    timing.append((filename, time.time() - t0, os.path.getsize(filename)))
+report('section', timing)
+
+p.cfg['plot_batch'] = dict(info, site=sites,
+                           plotfilename=os.path.join(outdir,
+                                                     'batch_{site}.png'),
+                           plot='plotHovmollerDoyVsHodMeanBatch')
+fig, axes, timing = plot.plotHovmollerDoyVsHodMeanBatch(p, 'plot_batch')
+plt.close(fig)
+report('batch', timing)
+print('figures in {}'.format(outdir))
@@ -0,0 +1,46 @@
+"""Measure the peak memory for ingesting all sources at a single site and
+   calculating the stats for all models against the flux observations.
+   Run once without and once with a chunksize; each run needs its own process
+   because the peak resident set size can only go up. The baseline is taken
+   after opening the first file, so that it includes the one-off cost of
+   loading the netcdf libraries.
+
+   Usage: python measure_ingest_memory.py <configuration file> <site>
+          [<chunksize>]"""
+import sys
+import time
+import plumber.plumber as pl
+from plumber import io
+from plumber import stats
+from plumber import utils
+
+try:
+    configfile = sys.argv[1]
+    site = sys.argv[2]
+except IndexError:
+    sys.exit('Usage: {} <configuration file> <site> [<chunksize>]'.
+             format(sys.argv[0]))
+try:
+    chunksize = int(sys.argv[3])
+except IndexError:
+    chunksize = None
+
+b = pl.PlumberAnalysis(configfile)
+b.cfg['sites']['sites'] = [site]
+io.openDataset(next(b.atoms())[2], 'all', derive=False).close()
+baseline = utils.peakMemory()
+t0 = time.time()
+b.ingestAll(chunksize=chunksize)
+t1 = time.time()
+ingested = utils.peakMemory()
+for source in b.data[site]:
+    if source in b.cfg['observations']['observations']:
+        continue
+    stats.calcAllStatsChunked(b.data[site][source], b.data[site]['flux'])
+t2 = time.time()
+print('site: {} chunksize: {}'.format(site, chunksize))
+print('peak RSS before ingest : {:8.1f} MB'.format(baseline))
+print('peak RSS after ingest  : {:8.1f} MB ({:.1f} s)'.format(ingested,
+                                                             t1-t0))
+print('peak RSS after stats   : {:8.1f} MB ({:.1f} s)'.
+      format(utils.peakMemory(), t2-t1))
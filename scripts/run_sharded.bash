@@ -0,0 +1,33 @@
+#!/bin/bash
+# Run ingest, stats and plotting in N local processes (one per shard) and
+# merge the partial stores into a single stored analysis. The plot sections
+# that need data from more than one shard are made after the merge. On a
+# cluster, run each shard on its own node with the same shared output
+# directory and run the merge after all shards have finished.
+# Usage: run_sharded.bash <configuration file> [<nshards>] [<outdir>] [site|atom]
+
+config=$1
+nshards=${2:-4}
+outdir=${3:-sharded}
+shardby=${4:-site}
+
+if [ -z "${config}" ]; then
+  echo "Usage: $0 <configuration file> [<nshards>] [<outdir>] [site|atom]"
+  exit 1
+fi
+
+for ((i=0; i<nshards; i++))
+do
+  python -m plumber.plumber ${config} --ingest --stats --plot \
+    --shard ${i}/${nshards} --shard-by ${shardby} \
+    --store ${outdir}/shard_${i}_of_${nshards} &
+done
+wait
+
+shards=""
+for ((i=0; i<nshards; i++))
+do
+  shards="${shards} ${outdir}/shard_${i}_of_${nshards}"
+done
+python -m plumber.plumber ${config} --merge ${shards} --store ${outdir}/merged \
+  --plot
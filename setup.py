@@ -9,6 +9,8 @@ setup(name='plumber_analysis',
       author_email='nijssen@uw.edu',
       url='http://www.github.com/bartnijssen/plumber_analysis',
       packages=['plumber'],
-      py_modules=['plumber.fargs', 'plumber.io', 'plumber.plot',
-                  'plumber.plumber', 'plumber.stats', 'plumber.utils']
+      py_modules=['plumber.aggregate', 'plumber.fargs', 'plumber.io',
+                  'plumber.plot', 'plumber.plumber', 'plumber.server',
+                  'plumber.spectral', 'plumber.stats', 'plumber.utils',
+                  'plumber.validity']
       )
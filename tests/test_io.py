@@ -0,0 +1,55 @@
+"""Tests for plumber.io"""
+import numpy as np
+import pytest
+
+xray = pytest.importorskip('xray')
+from plumber import io  # noqa: E402
+
+
+def writeIrregular(path):
+    """Write a netcdf file with irregular half-hourly time stamps, including
+       raw time steps that are equally far from a time step on the regular
+       grid"""
+    minutes = np.array([0, 15, 45, 60, 89, 121, 150, 180, 195, 240, 270])
+    values = np.arange(len(minutes), dtype=float)
+    values[4] = np.nan
+    ds = xray.Dataset({'Qle': ('time', values), 'Qh': ('time', 2*values)},
+                      coords={'time': minutes * 60.})
+    ds['time'].attrs['units'] = 'seconds since 2000-01-01 00:00:00'
+    ds.to_netcdf(path)
+
+
+@pytest.mark.parametrize('tshift', [None, -15, 30])
+@pytest.mark.parametrize('chunksize', [1, 3, 100])
+def test_chunked_matches_ingest(tmpdir, tshift, chunksize):
+    infile = str(tmpdir.join('irregular.nc'))
+    writeIrregular(infile)
+    expected = io.ingest(infile, 'all', tshift=tshift)
+    chunked = io.ingest(infile, 'all', tshift=tshift, chunksize=chunksize)
+    assert isinstance(chunked, io.ChunkedTimeSeries)
+    assert chunked.index.equals(expected.index)
+    df = chunked.toDataFrame()
+    for var in expected.columns:
+        np.testing.assert_array_equal(df[var].values,
+                                      expected[var].values)
+
+
+@pytest.mark.parametrize('read_vars', ['all', ['Rnet'], ['Qle', 'Rnet']])
+def test_chunked_derives_rnet(tmpdir, read_vars):
+    infile = str(tmpdir.join('radiation.nc'))
+    minutes = np.arange(0, 30*200, 30)
+    values = np.sin(minutes / 300.)
+    values[7] = np.nan
+    ds = xray.Dataset({'Qle': ('time', values), 'SWnet': ('time', 3*values),
+                       'LWnet': ('time', -values)},
+                      coords={'time': minutes * 60.})
+    ds['time'].attrs['units'] = 'seconds since 2000-01-01 00:00:00'
+    ds.to_netcdf(infile)
+    expected = io.ingest(infile, read_vars)
+    chunked = io.ingest(infile, read_vars, chunksize=7)
+    assert 'Rnet' in expected.columns
+    assert chunked.columns == sorted(expected.columns)
+    assert chunked.derived == {'Rnet': ['SWnet', 'LWnet']}
+    df = chunked.toDataFrame()
+    for var in expected.columns:
+        np.testing.assert_array_equal(df[var].values, expected[var].values)
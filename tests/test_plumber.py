@@ -0,0 +1,73 @@
+"""Tests for plumber.plumber"""
+import numpy as np
+import pytest
+
+xray = pytest.importorskip('xray')
+from plumber import plumber as pl  # noqa: E402
+
+# late (positive) or early (negative) output of each model in minutes
+offsets = {'Late60': 60, 'Late7': 7, 'Early40': -40, 'OnTime': 0}
+
+
+def writeSite(path, name, offset, seed):
+    """Write 60 days of half-hourly output with a diurnal cycle that is
+       offset minutes late"""
+    rng = np.random.RandomState(seed)
+    seconds = np.arange(48*60) * 1800.
+    hours = (seconds / 3600. - offset / 60.) % 24
+    amplitude = 1 + 0.3 * np.sin(seconds / 86400. / 9)
+    cycle = amplitude * (np.cos(2*np.pi*(hours - 13)/24) +
+                         0.3*np.cos(4*np.pi*(hours - 11)/24))
+    values = 100 * cycle + rng.normal(0, 5, len(seconds))
+    ds = xray.Dataset({'Qle': ('time', values)},
+                      coords={'time': seconds})
+    ds['time'].attrs['units'] = 'seconds since 2001-01-01 00:00:00'
+    ds.to_netcdf(str(path.join(name)))
+
+
+@pytest.fixture
+def analysis(tmpdir):
+    writeSite(tmpdir, 'flux_S.nc', 0, 0)
+    for i, model in enumerate(sorted(offsets)):
+        writeSite(tmpdir, '{}_S.nc'.format(model), offsets[model], i+1)
+    configfile = tmpdir.join('test.config')
+    configfile.write('\n'.join([
+        '[SOURCES]', 'lsms = {}'.format(','.join(sorted(offsets))),
+        '[SITES]', 'sites = S,',
+        '[FILETEMPLATES]',
+        'lsms_file_template = {}/{{model}}_{{site}}.nc'.format(tmpdir),
+        'flux_file_template = {}/flux_{{site}}.nc'.format(tmpdir),
+        '[OBSERVATIONS]', 'observations = flux,', '[TSHIFTS]', '']))
+    p = pl.PlumberAnalysis(str(configfile))
+    p.ingestAll()
+    return p
+
+
+def test_detectTimeShifts(analysis):
+    shifts = analysis.detectTimeShifts()
+    for model, offset in offsets.items():
+        assert shifts.loc[model, 'lag'] == pytest.approx(offset, abs=2)
+        assert shifts.loc[model, 'agreement'] == 1
+    # late output gets a negative shift, in whole time steps and only for
+    # lags of at least min_lag
+    assert shifts.loc['Late60', 'suggested_tshift'] == -60
+    assert shifts.loc['Early40', 'suggested_tshift'] == 30
+    assert shifts.loc['Late7', 'suggested_tshift'] == 0
+    assert shifts.loc['OnTime', 'suggested_tshift'] == 0
+    shifts = analysis.detectTimeShifts(min_lag=45)
+    assert shifts.loc['Early40', 'suggested_tshift'] == 0
+    assert shifts.loc['Late60', 'suggested_tshift'] == -60
+
+
+def test_applyTimeShifts(analysis):
+    analysis.detectTimeShifts(apply=True)
+    assert analysis.cfg['tshifts'] == {'late60': -60, 'early40': 30}
+    flux = analysis.validity['S']['flux']
+    for model in offsets:
+        assert analysis._sameGrid('S', model, 'flux')
+    assert analysis.validity['S']['Late60'].start == \
+        flux.start - pl.validity.freq * 2
+    shifts = analysis.detectTimeShifts()
+    assert shifts.loc['Late60', 'lag'] == pytest.approx(0, abs=2)
+    assert shifts.loc['Early40', 'lag'] == pytest.approx(-10, abs=2)
+    assert (shifts['suggested_tshift'] == shifts['tshift']).all()
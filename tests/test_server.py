@@ -0,0 +1,85 @@
+"""Tests for plumber.server"""
+import os
+import socket
+import threading
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('xray')
+from plumber import plumber as pl  # noqa: E402
+from plumber import server  # noqa: E402
+
+
+def makeAnalysis():
+    """Analysis with a model and observations at a single site and stored
+       daily aggregates"""
+    rng = np.random.RandomState(0)
+    index = pd.date_range('2001-06-01', '2001-08-31 23:30', freq='30Min')
+    p = pl.PlumberAnalysis()
+    for source in ['m1', 'flux']:
+        df = pd.DataFrame({'Qle': rng.normal(100, 20, len(index)),
+                           'Qh': rng.normal(50, 10, len(index))},
+                          index=index)
+        df.iloc[100:200, 0] = np.nan
+        p._addAtom('A', source, df)
+        p.buildAggregates('A', source, ['daily'])
+    return p
+
+
+@pytest.fixture
+def client(tmpdir):
+    p = makeAnalysis()
+    path = str(tmpdir.join('plumber.sock'))
+    srv = server.UnixPlumberServer(path, p)
+    thread = threading.Thread(target=srv.serve_forever)
+    thread.start()
+    yield p, server.PlumberClient(path)
+    srv.shutdown()
+    srv.server_close()
+    thread.join()
+    assert not os.path.exists(path)
+
+
+@pytest.mark.parametrize('time', [
+    None,
+    '2001-07',
+    slice('2001-07-01', '2001-07-02'),
+    slice('2001-07-01 00:00', '2001-07-02 12:00'),
+    slice(pd.Timestamp('2001-07-01 06:30'), pd.Timestamp('2001-07-03')),
+    slice('2001-08-30 12:00', None),
+])
+def test_select_round_trip(client, time):
+    p, c = client
+    expected = p.select('A', ['m1', 'flux'], 'Qle', time, stack=True)
+    result = c.select('A', ['m1', 'flux'], 'Qle', time=time)
+    assert len(result) > 0
+    assert result.index.equals(expected.index)
+    assert list(result.columns) == list(expected.columns)
+    np.testing.assert_array_equal(result.values, expected.values)
+
+
+def test_stats_only_from_stored_aggregates(client):
+    p, c = client
+    expected = pd.DataFrame(p.calcAtomStats('A', 'm1', level='daily'))
+    result = c.stats('A', 'm1', level='daily')
+    np.testing.assert_allclose(result.values, expected.values)
+    with pytest.raises(KeyError):
+        c.stats('A', 'm1', level='monthly')
+    assert sorted(p.aggregates['A']['m1']) == ['daily']
+
+
+def test_stale_socket(tmpdir):
+    path = str(tmpdir.join('plumber.sock'))
+    # a socket file that is left over from a server that has stopped
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.close()
+    assert os.path.exists(path)
+    srv = server.UnixPlumberServer(path, makeAnalysis())
+    try:
+        with pytest.raises(OSError):
+            server.UnixPlumberServer(path, makeAnalysis())
+    finally:
+        srv.server_close()
+    assert not os.path.exists(path)
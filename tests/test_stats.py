@@ -0,0 +1,81 @@
+"""Tests for plumber.stats"""
+import numpy as np
+import pandas as pd
+import pytest
+from plumber import stats
+
+
+def makeData(seed=0):
+    """Synthetic obs and model data with gaps in different places and an
+       all-NaN column"""
+    rng = np.random.RandomState(seed)
+    index = pd.date_range('2001-01-01', '2002-12-31 23:30', freq='30Min')
+    n = len(index)
+    hours = np.asarray(index.hour) + np.asarray(index.minute) / 60.
+    cycle = np.clip(np.sin((hours - 6) / 12 * np.pi), 0, None)
+    obs = pd.DataFrame({'Qle': 200*cycle + rng.normal(0, 20, n),
+                        'Qh': 100*cycle + rng.gamma(2, 10, n),
+                        'NEE': np.nan}, index=index)
+    model = pd.DataFrame({'Qle': 180*cycle + rng.normal(0, 30, n),
+                          'Qh': 120*cycle + rng.gamma(3, 8, n),
+                          'NEE': rng.normal(0, 1, n)}, index=index)
+    obs.iloc[1000:3000, :2] = np.nan
+    model.iloc[rng.randint(0, n, 2000), 0] = np.nan
+    return model, obs
+
+
+def pairwise(df1, df2):
+    """Mask df1 and df2 where either one is missing"""
+    invalid = df1.isnull() | df2.isnull()
+    return df1.mask(invalid), df2.mask(invalid)
+
+
+def assertStatsEqual(result, expected, variables):
+    """Compare stats for variables. calcAllStats leaves variables without
+       any valid data out of some metrics, which counts as NaN"""
+    assert sorted(result) == sorted(expected)
+    for metric in expected:
+        np.testing.assert_allclose(
+            result[metric].reindex(variables).values.astype(float),
+            expected[metric].reindex(variables).values.astype(float),
+            rtol=1e-9, atol=1e-12, err_msg=metric)
+
+
+@pytest.mark.parametrize('chunksize', [1000, 48*365, 10**6])
+def test_chunked_matches_calcAllStats(chunksize):
+    model, obs = makeData()
+    variables = ['NEE', 'Qh', 'Qle']
+    expected = stats.calcAllStats(*pairwise(model, obs))
+    result = stats.calcAllStatsChunked(model, obs, chunksize=chunksize,
+                                       pairwise=True)
+    assertStatsEqual(result, expected, variables)
+
+
+def test_chunked_without_pairwise():
+    model, obs = makeData(1)
+    variables = ['Qh', 'Qle']
+    expected = stats.calcAllStats(model[variables], obs[variables])
+    result = stats.calcAllStatsChunked(model, obs, chunksize=5000,
+                                       variables=variables)
+    assertStatsEqual(result, expected, variables)
+
+
+def test_grouped_matches_calcAllStats():
+    model, obs = makeData(2)
+    variables = ['NEE', 'Qh', 'Qle']
+    # months, with some time steps left out and an empty extra group
+    codes, labels = stats.groupCodes(model.index, 'month')
+    codes = codes.copy()
+    codes[::7] = -1
+    labels = labels + ['empty']
+    result = stats.calcGroupedStats(model, obs, codes, labels)
+    model, obs = pairwise(model, obs)
+    for code, label in enumerate(labels):
+        group = result[result['group'] == label].pivot(
+            index='variable', columns='metric', values='value')
+        if label == 'empty':
+            assert group.isnull().values.all()
+            continue
+        selected = codes == code
+        expected = stats.calcAllStats(model[selected], obs[selected])
+        assertStatsEqual(group, expected, variables)
@@ -0,0 +1,98 @@
+"""Tests for plumber.validity"""
+import numpy as np
+import pandas as pd
+import pytest
+from plumber import validity
+
+
+def makeFrame(seed=0):
+    """Half-hourly frame with random gaps, a long gap and an all-NaN
+       column"""
+    rng = np.random.RandomState(seed)
+    index = pd.date_range('2001-01-01', periods=48*90, freq='30Min')
+    df = pd.DataFrame({'Qle': rng.normal(size=len(index)),
+                       'Qh': rng.normal(size=len(index)),
+                       'NEE': np.nan}, index=index)
+    df.loc[rng.rand(len(index)) < 0.2, 'Qle'] = np.nan
+    df.iloc[500:900, 1] = np.nan
+    df.iloc[-3:, 1] = np.nan
+    return df
+
+
+@pytest.mark.parametrize('start, end', [
+    (None, None),
+    ('2001-01-02', '2001-01-03'),
+    ('2001-01', '2001-02'),
+    ('2001-01-02 12:00', '2001-01-03 01:15'),
+    (pd.Timestamp('2001-01-05 10:10'), pd.Timestamp('2001-01-06')),
+    ('2001-03-15', None),
+    (None, '2001-01-01'),
+])
+def test_count_matches_loc(start, end):
+    df = makeFrame()
+    index = validity.ValidityIndex(df)
+    for var in df.columns:
+        expected = df.loc[start:end, var]
+        assert index.count(var, start, end) == expected.count()
+        np.testing.assert_array_equal(index.mask(var, start, end),
+                                      expected.notnull().values)
+        assert index.coverage(var, start, end) == \
+            pytest.approx(expected.count() / len(expected))
+
+
+def test_window_outside_record():
+    df = makeFrame()
+    index = validity.ValidityIndex(df)
+    assert index.count('Qle', '2000-01-01', '2000-12-31') == 0
+    assert index.count('Qle', '2000-12-31 23:00', '2001-01-01 00:30') == \
+        df['Qle'].iloc[:2].count()
+    mask = index.mask('Qh', '2000-12-31 23:00', '2001-01-01 00:30')
+    np.testing.assert_array_equal(mask, [False, False] +
+                                  list(df['Qh'].iloc[:2].notnull()))
+
+
+def test_longestValidWindow():
+    df = makeFrame()
+    index = validity.ValidityIndex(df)
+    for var in df.columns:
+        start, end, length = index.longestValidWindow(var)
+        valid = df[var].notnull().values
+        runs = np.diff(np.flatnonzero(np.diff(np.concatenate(
+            [[0], valid.astype(int), [0]]))))[::2]
+        assert length == (runs.max() if len(runs) else 0)
+        if length:
+            window = df.loc[start:end, var]
+            assert len(window) == length
+            assert window.notnull().all()
+        else:
+            assert start is None and end is None
+
+
+@pytest.mark.parametrize('chunksize', [1, 7, 1000, 10**5])
+def test_fromChunks_matches_frame(chunksize):
+    df = makeFrame()
+    expected = validity.ValidityIndex(df)
+    chunks = (df.iloc[i:i+chunksize] for i in range(0, len(df), chunksize))
+    index = validity.ValidityIndex.fromChunks(chunks)
+    assert index.start == expected.start
+    assert index.length == expected.length
+    assert sorted(index.bitmaps) == sorted(expected.bitmaps)
+    for var in df.columns:
+        np.testing.assert_array_equal(index.bitmaps[var],
+                                      expected.bitmaps[var])
+        np.testing.assert_array_equal(index.gaps[var], expected.gaps[var])
+
+
+def test_pairwiseValid():
+    df1 = makeFrame(1)
+    df2 = makeFrame(2).iloc[100:-200].drop('Qh', axis=1)
+    index1 = validity.ValidityIndex(df1)
+    index2 = validity.ValidityIndex(df2)
+    result1, result2 = validity.pairwiseValid(df1, df2, index1, index2)
+    assert list(result1.columns) == ['Qle', 'NEE']
+    assert result1.index.equals(df2.index)
+    assert result2.index.equals(df2.index)
+    common = df1.loc[df2.index, ['Qle', 'NEE']]
+    invalid = common.isnull() | df2[['Qle', 'NEE']].isnull()
+    pd.testing.assert_frame_equal(result1, common.mask(invalid))
+    pd.testing.assert_frame_equal(result2, df2[['Qle', 'NEE']].mask(invalid))